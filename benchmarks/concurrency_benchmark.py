@@ -0,0 +1,79 @@
+"""
+Concurrency benchmark for the Granite Retrieval Agent pipe.
+
+Runs batches of simultaneous `Pipe.pipe` invocations against the local stand-ins for the
+OpenAI-compatible endpoint and SearXNG in mock_services.py (each answering after a fixed delay)
+and reports how throughput scales with the number of simultaneous requests.
+
+Usage:
+    python benchmarks/concurrency_benchmark.py --latency 0.2 --concurrency 1 2 4 8
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from mock_services import install_open_webui_stubs, start_mock_backend
+
+
+####################
+# Benchmark
+####################
+async def consume(pipe_call):
+    # With STREAM_FINAL_ANSWER the pipe returns an async generator of tokens
+    result = await pipe_call
+    if isinstance(result, str):
+        return result
+    return "".join([chunk async for chunk in result])
+
+
+async def run_batch(pipe, concurrency):
+    body = {"messages": [{"role": "user", "content": "Find the latest news about Granite models."}]}
+    start = time.perf_counter()
+    # AutoGen prints every agent message to stdout; keep the report readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = await asyncio.gather(*[consume(pipe.pipe(body)) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    return elapsed, results
+
+
+async def main(args):
+    install_open_webui_stubs()
+    from granite_autogen_rag import Pipe
+
+    server = start_mock_backend(args.latency)
+    host, port = server.server_address
+    pipe = Pipe()
+    pipe.valves.OPENAI_API_URL = f"http://{host}:{port}/v1"
+    pipe.valves.SEARX_HOST = f"http://{host}:{port}/search"
+    pipe.valves.FAST_WORKFLOW = args.fast_workflow
+    pipe.valves.STREAM_FINAL_ANSWER = args.stream
+    pipe.valves.MAX_CONCURRENT_LLM_CALLS = args.max_concurrent_llm_calls
+    # Every request asks the same question, so with the search cache on only the first batch would search
+    pipe.valves.SEARCH_CACHE_TTL_SECONDS = 0
+
+    print(f"{'concurrency':>12} {'wall time (s)':>14} {'requests/s':>12} {'speedup':>8}")
+    baseline = None
+    for concurrency in args.concurrency:
+        elapsed, _ = await run_batch(pipe, concurrency)
+        throughput = concurrency / elapsed
+        baseline = baseline or throughput
+        print(f"{concurrency:>12} {elapsed:>14.2f} {throughput:>12.2f} {throughput / baseline:>7.2f}x")
+
+    await pipe.agent_pool.close()
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds each mock LLM or Searx call takes")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8], help="Simultaneous requests per batch")
+    parser.add_argument("--fast-workflow", action="store_true", help="Run the pipe with the FAST_WORKFLOW valve enabled")
+    parser.add_argument("--max-concurrent-llm-calls", type=int, default=8, help="Value of the MAX_CONCURRENT_LLM_CALLS valve. 0 for no limit")
+    parser.add_argument("--stream", action="store_true", help="Run the pipe with the STREAM_FINAL_ANSWER valve enabled")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,229 @@
+"""
+Local stand-ins for the services the Granite Retrieval Agent pipe talks to, so it can be benchmarked offline:
+an OpenAI-compatible chat completions endpoint with scripted agent replies, a SearXNG JSON API (both served
+by one HTTP server, each answering after a configurable delay), and Open WebUI's knowledge base modules.
+"""
+import ast
+import json
+import sys
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+####################
+# Open WebUI stand-ins
+####################
+KNOWLEDGE_DOCUMENTS = [
+    ("meeting-notes.md", "Our team is migrating the inference platform to Kubernetes and serving Granite models with vLLM."),
+    ("meeting-notes.md", "The data pipeline project uses Ray for distributed preprocessing of training data."),
+    ("roadmap.md", "Next quarter the team plans to evaluate retrieval augmented generation with Granite embedding models."),
+]
+
+
+# The pipe imports Open WebUI's retrieval router and knowledge model, which need a configured
+# Open WebUI installation and database. These minimal modules serve two knowledge bases with a few documents each.
+def install_open_webui_stubs(search_latency=0.0):
+    if "open_webui" in sys.modules:
+        return
+
+    class QueryCollectionsForm:
+        def __init__(self, collection_names, query, k=None):
+            self.collection_names = collection_names
+            self.query = query
+            self.k = k
+
+    class KnowledgeTable:
+        def get_knowledge_bases(self):
+            return [types.SimpleNamespace(id="work-notes"), types.SimpleNamespace(id="team-roadmap")]
+
+        def get_knowledge_bases_by_user_id(self, user_id, permission="write"):
+            return self.get_knowledge_bases()
+
+    def query_collection_handler(form_data):
+        time.sleep(search_latency)
+        entries = [(name, content) for name, content in KNOWLEDGE_DOCUMENTS][: form_data.k or len(KNOWLEDGE_DOCUMENTS)]
+        return {
+            "documents": [[content for _, content in entries]],
+            "metadatas": [[{"name": name} for name, _ in entries]],
+            "distances": [[1.0 - index * 0.1 for index in range(len(entries))]],
+        }
+
+    modules = {}
+    for name in ["open_webui", "open_webui.routers", "open_webui.routers.retrieval", "open_webui.models", "open_webui.models.knowledge"]:
+        modules[name] = types.ModuleType(name)
+    modules["open_webui.routers.retrieval"].QueryCollectionsForm = QueryCollectionsForm
+    modules["open_webui.routers.retrieval"].query_collection_handler = query_collection_handler
+    modules["open_webui.models.knowledge"].KnowledgeTable = KnowledgeTable
+    sys.modules.update(modules)
+
+
+####################
+# Scripted agent replies
+####################
+def scripted_plan(query):
+    """
+    A plan for the query in the planner's format: a documents step for queries about the user's own work,
+    one web search step per topic for queries listing several topics, and a final summary step when there are several steps.
+    """
+    steps = []
+    if any(word in query.lower() for word in ["my ", "our ", "i'm ", "notes", "documents"]):
+        steps.append({"id": 1, "instruction": "Query documents for the technologies used", "depends_on": []})
+    topics = query.rstrip(".?").split("about ")[-1].replace(" and ", ", ").split(", ")
+    first_search_id = len(steps) + 1
+    for topic in topics:
+        steps.append({"id": len(steps) + 1, "instruction": f"Search the internet for the latest news about {topic}", "depends_on": [1] if first_search_id > 1 else []})
+    if len(steps) > 1:
+        steps.append({"id": len(steps) + 1, "instruction": "Summarize the findings", "depends_on": [step["id"] for step in steps]})
+    return {"plan": steps}
+
+
+def next_plan_step(message):
+    """
+    The first step of the plan in a reflection or step review message that has not been taken yet, or ##TERMINATE##.
+    """
+    try:
+        fields = ast.literal_eval(message)
+        plan = ast.literal_eval(fields["Plan"])["plan"]
+        taken = ast.literal_eval(fields["Steps Taken"]) + [fields.get("Last Step"), fields.get("Instruction")]
+    except (ValueError, SyntaxError, KeyError, TypeError):
+        return "##TERMINATE##"
+    remaining = [step for step in plan if step not in taken]
+    return remaining[0] if remaining else "##TERMINATE##"
+
+
+def scripted_reply(messages):
+    """
+    Pick a canned reply for a chat completion request based on which agent sent it.
+    Returns (content, tool_calls).
+    """
+    system = messages[0]["content"] if messages and messages[0]["role"] == "system" else ""
+    last = messages[-1]
+    last_content = last.get("content") or ""
+
+    if system.startswith("You are a task planner"):
+        return json.dumps(scripted_plan(last_content)), None
+    # With structured output, the critic and reflection prompts end by asking for json
+    structured = "respond only with json" in last_content
+    last_content = last_content.split("\n    Instead of")[0]
+
+    if system.startswith("You are an assistant. Please tell me what is the next step"):
+        next_step = next_plan_step(last_content)
+        if structured:
+            return json.dumps({"terminate": next_step == "##TERMINATE##", "next_step": "" if next_step == "##TERMINATE##" else next_step}), None
+        return next_step, None
+    if system.startswith("You are an assistant that reviews each step"):
+        review = {"answer": "Granite models were updated this week.", "accomplished": True, "reason": "", "next_step": next_plan_step(last_content)}
+        return json.dumps(review), None
+    if system.startswith("You are an AI assistant."):
+        if last["role"] == "tool":
+            return "##SUMMARY## " + (last_content[:200] or "Granite models were updated this week."), None
+        instruction = next((message.get("content") or "" for message in messages if message["role"] == "user"), "")
+        if instruction.startswith("Summarize"):
+            return "##SUMMARY## Granite models were updated this week.", None
+        tool = "personal_knowledge_search" if instruction.startswith("Query documents") else "web_search"
+        tool_call = {
+            "id": "call_0",
+            "type": "function",
+            "function": {"name": tool, "arguments": json.dumps({"search_instruction": instruction.split("\n")[0]})},
+        }
+        # Like Ollama, tool calls come with empty content
+        return "", [tool_call]
+    if last_content.startswith("Decide whether the following query"):
+        query = last_content.split("Query:")[-1]
+        return ("##COMPLEX##" if len(query.split()) > 12 or "," in query else "##SIMPLE##"), None
+    if "suggest" in last_content and "search term" in last_content:
+        return "granite model news", None
+    if "reply with ##YES##" in last_content:
+        return (json.dumps({"accomplished": True, "reason": ""}) if structured else "##YES##"), None
+    if last_content.startswith("You maintain a running summary"):
+        return "Granite models were updated this week, and the team uses Kubernetes, Ray and vLLM.", None
+    return "Granite models were updated this week.", None
+
+
+def estimate_tokens(text):
+    return (len(text) + 3) // 4
+
+
+####################
+# Mock backends
+####################
+class MockBackendHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    search_latency = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_stream(self, request, content):
+        # Server-sent events, one word per chunk
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        words = content.split(" ")
+        for index, word in enumerate(words):
+            delta = {"role": "assistant", "content": word if index == 0 else " " + word}
+            chunk = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": int(time.time()), "model": request.get("model", "mock"),
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": "stop" if index == len(words) - 1 else None}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+    def do_GET(self):
+        # SearXNG JSON API
+        time.sleep(self.search_latency)
+        self.send_json({
+            "query": "",
+            "answers": [],
+            "results": [
+                {"url": "https://example.com/granite", "title": "Granite", "content": "Granite models were updated this week."},
+                {"url": "https://example.com/vllm", "title": "vLLM", "content": "vLLM added support for new Granite models."},
+            ],
+        })
+
+    def do_POST(self):
+        # OpenAI-compatible chat completions
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        time.sleep(self.latency)
+        messages = request.get("messages", [])
+        content, tool_calls = scripted_reply(messages)
+        if request.get("stream"):
+            self.send_stream(request, content)
+            return
+        message = {"role": "assistant", "content": content}
+        if tool_calls:
+            message["tool_calls"] = tool_calls
+        # Token counts are estimated from the text, which is enough to compare prompt sizes between runs
+        prompt_tokens = sum(estimate_tokens(str(message.get("content") or "")) for message in messages) + estimate_tokens(json.dumps(request.get("tools", [])))
+        completion_tokens = estimate_tokens(content + json.dumps(tool_calls or ""))
+        self.send_json({
+            "id": "chatcmpl-mock",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "mock"),
+            "choices": [{"index": 0, "message": message, "finish_reason": "tool_calls" if tool_calls else "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens},
+        })
+
+
+def start_mock_backend(latency, search_latency=None):
+    """
+    Serve the mock chat completions endpoint (POST) and SearXNG API (GET) on a free local port, in a background thread.
+    """
+    search_latency = latency if search_latency is None else search_latency
+    handler = type("Handler", (MockBackendHandler,), {"latency": latency, "search_latency": search_latency})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
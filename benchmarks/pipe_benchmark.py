@@ -0,0 +1,196 @@
+"""
+End-to-end benchmark for the Granite Retrieval Agent pipe.
+
+Replays a corpus of queries through `Pipe.pipe` against the offline stand-ins in mock_services.py,
+at one or more levels of concurrency, and reports per-request latency (p50/p95), LLM calls and prompt
+tokens per request (read from the pipe's own traces), and throughput.
+
+Results can be saved with --output and later compared against with --baseline, in which case the
+benchmark exits with an error when any number regressed by more than --tolerance.
+
+Usage:
+    python benchmarks/pipe_benchmark.py --latency 0.1 --concurrency 1 4
+    python benchmarks/pipe_benchmark.py --output baseline.json
+    python benchmarks/pipe_benchmark.py --baseline baseline.json --tolerance 0.1
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from mock_services import install_open_webui_stubs, start_mock_backend
+
+DEFAULT_CORPUS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "queries.json")
+
+# Metric -> whether a higher value is better, for comparison against a baseline
+METRICS = {
+    "p50_seconds": False,
+    "p95_seconds": False,
+    "llm_calls_per_request": False,
+    "prompt_tokens_per_request": False,
+    "requests_per_second": True,
+}
+
+
+def percentile(values, percent):
+    # Nearest-rank percentile
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)]
+
+
+def read_traces(trace_file):
+    """
+    Total LLM calls and prompt tokens of each request traced in a JSON lines trace file.
+    """
+    totals = {}
+    with open(trace_file, encoding="utf-8") as file:
+        for line in file:
+            span = json.loads(line)
+            trace = totals.setdefault(span["trace_id"], {"llm_calls": 0, "prompt_tokens": 0})
+            for attribute in trace:
+                trace[attribute] += span["attributes"].get(attribute, 0)
+    return list(totals.values())
+
+
+async def run_request(pipe, query):
+    start = time.perf_counter()
+    result = await pipe.pipe({"messages": [{"role": "user", "content": query}]})
+    # With STREAM_FINAL_ANSWER the pipe returns an async generator of tokens
+    if not isinstance(result, str):
+        result = "".join([chunk async for chunk in result])
+    return time.perf_counter() - start
+
+
+async def run_level(pipe, queries, concurrency, trace_file):
+    """
+    Replay the queries with at most `concurrency` requests in flight, and summarize the run.
+    """
+    open(trace_file, "w").close()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(query):
+        async with semaphore:
+            return await run_request(pipe, query)
+
+    start = time.perf_counter()
+    # AutoGen prints every agent message to stdout; keep the report readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        latencies = await asyncio.gather(*[bounded(query) for query in queries])
+    elapsed = time.perf_counter() - start
+
+    traces = read_traces(trace_file)
+    return {
+        "concurrency": concurrency,
+        "requests": len(queries),
+        "p50_seconds": percentile(latencies, 50),
+        "p95_seconds": percentile(latencies, 95),
+        "llm_calls_per_request": sum(trace["llm_calls"] for trace in traces) / max(len(traces), 1),
+        "prompt_tokens_per_request": sum(trace["prompt_tokens"] for trace in traces) / max(len(traces), 1),
+        "requests_per_second": len(queries) / elapsed,
+    }
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+    Return a description of every metric that is worse than the baseline by more than the tolerance.
+    """
+    regressions = []
+    baseline_levels = {level["concurrency"]: level for level in baseline["levels"]}
+    for level in results["levels"]:
+        baseline_level = baseline_levels.get(level["concurrency"])
+        if baseline_level is None:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            value, reference = level[metric], baseline_level[metric]
+            worse = value < reference * (1 - tolerance) if higher_is_better else value > reference * (1 + tolerance)
+            if worse:
+                regressions.append(f"concurrency {level['concurrency']}: {metric} is {value:.2f}, baseline {reference:.2f}")
+    return regressions
+
+
+async def main(args):
+    install_open_webui_stubs(search_latency=args.search_latency)
+    from granite_autogen_rag import Pipe
+
+    with open(args.corpus, encoding="utf-8") as file:
+        queries = json.load(file) * args.repeat
+
+    server = start_mock_backend(args.latency, args.search_latency)
+    host, port = server.server_address
+    trace_file = os.path.join(tempfile.mkdtemp(), "traces.jsonl")
+    pipe = Pipe()
+    pipe.valves.OPENAI_API_URL = f"http://{host}:{port}/v1"
+    pipe.valves.SEARX_HOST = f"http://{host}:{port}/search"
+    pipe.valves.FAST_WORKFLOW = args.fast_workflow
+    pipe.valves.STREAM_FINAL_ANSWER = args.stream
+    pipe.valves.MAX_PARALLEL_STEPS = args.max_parallel_steps
+    pipe.valves.QUERY_ROUTER = args.query_router
+    pipe.valves.STRUCTURED_OUTPUT = args.structured_output
+    pipe.valves.MAX_CONCURRENT_LLM_CALLS = args.max_concurrent_llm_calls
+    pipe.valves.TRACE_FILE = trace_file
+    if not args.cache:
+        # The corpus repeats queries, so with the search cache on later requests would skip their searches
+        pipe.valves.SEARCH_CACHE_TTL_SECONDS = 0
+
+    # Build the agent pool and load the token encoding before measuring
+    with contextlib.redirect_stdout(io.StringIO()):
+        await run_request(pipe, queries[0])
+
+    results = {"settings": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")}, "levels": []}
+    print(f"{'concurrency':>12} {'requests':>9} {'p50 (s)':>8} {'p95 (s)':>8} {'LLM calls/req':>14} {'prompt tokens/req':>18} {'requests/s':>11}")
+    for concurrency in args.concurrency:
+        level = await run_level(pipe, queries, concurrency, trace_file)
+        results["levels"].append(level)
+        print(f"{concurrency:>12} {level['requests']:>9} {level['p50_seconds']:>8.2f} {level['p95_seconds']:>8.2f} "
+              f"{level['llm_calls_per_request']:>14.1f} {level['prompt_tokens_per_request']:>18.0f} {level['requests_per_second']:>11.2f}")
+
+    scheduler_stats = pipe.llm_scheduler.stats()
+    results["scheduler"] = scheduler_stats
+    print(f"LLM scheduler: limit {scheduler_stats['limit']}, {scheduler_stats['coalesced']} calls coalesced")
+    for lane, stats in scheduler_stats["lanes"].items():
+        print(f"  {lane}: {stats['admitted']} calls, average wait {stats['avg_wait_seconds']:.3f}s, longest wait {stats['max_wait_seconds']:.3f}s, longest queue {stats['max_waiting']}")
+
+    await pipe.agent_pool.close()
+    server.shutdown()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as file:
+            regressions = compare_to_baseline(results, json.load(file), args.tolerance)
+        if regressions:
+            print("Regressions against the baseline:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("No regressions against the baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", default=DEFAULT_CORPUS, help="JSON file with the list of queries to replay")
+    parser.add_argument("--repeat", type=int, default=1, help="How many times to replay the corpus at each concurrency level")
+    parser.add_argument("--latency", type=float, default=0.1, help="Seconds each mock LLM call takes")
+    parser.add_argument("--search-latency", type=float, default=0.05, help="Seconds each mock Searx or knowledge base query takes")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4], help="Most requests in flight at once, one run per value")
+    parser.add_argument("--fast-workflow", action="store_true", help="Run the pipe with the FAST_WORKFLOW valve enabled")
+    parser.add_argument("--stream", action="store_true", help="Run the pipe with the STREAM_FINAL_ANSWER valve enabled")
+    parser.add_argument("--max-parallel-steps", type=int, default=4, help="Value of the MAX_PARALLEL_STEPS valve")
+    parser.add_argument("--query-router", default="heuristic", choices=["heuristic", "llm", "off"], help="Value of the QUERY_ROUTER valve")
+    parser.add_argument("--structured-output", action="store_true", help="Run the pipe with the STRUCTURED_OUTPUT valve enabled")
+    parser.add_argument("--max-concurrent-llm-calls", type=int, default=8, help="Value of the MAX_CONCURRENT_LLM_CALLS valve")
+    parser.add_argument("--cache", action="store_true", help="Leave the search cache enabled")
+    parser.add_argument("--output", help="Save the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare the results to a JSON file saved with --output, and fail on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Fraction by which a metric may be worse than the baseline")
+    sys.exit(asyncio.run(main(parser.parse_args())))
@@ -1,15 +1,34 @@
 """
 requirements: autogen
 """
-from datetime import date, datetime
+from datetime import date
+from urllib.parse import urlsplit
 from autogen import coding, ConversableAgent
-from typing import Annotated, Any, Optional, Callable, Awaitable
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from functools import lru_cache, partial, wraps
+from typing import Annotated, Any, AsyncGenerator, Optional, Callable, Awaitable
 from open_webui.routers.retrieval import QueryCollectionsForm, query_collection_handler
 from open_webui.models.knowledge import KnowledgeTable
 from pydantic import BaseModel, Field
+import aiohttp
+import ast
+import asyncio
+import copy
+import hashlib
+import heapq
 import json
+import math
 import logging
+import re
+import sqlite3
+import time
+import uuid
 from langchain_community.utilities import SearxSearchWrapper
+from langchain_community.utilities.searx_search import SearxResults
+from openai import AsyncOpenAI
 
 ####################
 # Assistant prompts
@@ -20,16 +39,22 @@ PLANNER_MESSAGE = (
     1. Search through a collection of documents provided by the user. These are the user's own documents and will likely not have latest news or other information you can find on the internet.
     2. Synthesize, summarize and classify the information received.
     3. Search the internet
-    Please output the step using a properly formatted python dictionary and list. Respond only with the plan json as described below and no additional text. Here are a few examples:
+    Please output the plan using a properly formatted python dictionary and list. Each step has an "id", the "instruction" for the helper, and "depends_on": the ids of the earlier steps whose output the step needs.
+    Steps that do not need each other's output must not depend on each other, so that the helper can carry them out at the same time. Respond only with the plan json as described below and no additional text. Here are a few examples:
     Example 1: 
     User query: Write a performance self-assessment for Joe, consisting of a high-level overview of achievements for the year, a listing of the business impacts for each of these achievements, a list of skills developed and ways he's collaborated with the team.
     Your response:
-    ```{"plan": ["Query documents for all contributions involving Joe this year", "Quantify the business impact for Joe's contributions", "Enumerate the skills Joe has developed this year", "List several examples of how Joe's work has been accomplished via team collaboration", "Formulate the performance review based on collected information"]}```
+    ```{"plan": [{"id": 1, "instruction": "Query documents for all contributions involving Joe this year", "depends_on": []}, {"id": 2, "instruction": "Quantify the business impact for Joe's contributions", "depends_on": [1]}, {"id": 3, "instruction": "Enumerate the skills Joe has developed this year", "depends_on": [1]}, {"id": 4, "instruction": "List several examples of how Joe's work has been accomplished via team collaboration", "depends_on": [1]}, {"id": 5, "instruction": "Formulate the performance review based on collected information", "depends_on": [2, 3, 4]}]}```
 
     Example 2:
     User query: Find the latest news about the technologies I'm working on.
     Your response:
-    ```{"plan": ["Query documents for technologies used", "Search the internet for the latest news about each technology"]}```
+    ```{"plan": [{"id": 1, "instruction": "Query documents for technologies used", "depends_on": []}, {"id": 2, "instruction": "Search the internet for the latest news about each technology", "depends_on": [1]}]}```
+
+    Example 3:
+    User query: Find the latest news about Kubernetes, Ray and vLLM.
+    Your response:
+    ```{"plan": [{"id": 1, "instruction": "Search the internet for the latest news about Kubernetes", "depends_on": []}, {"id": 2, "instruction": "Search the internet for the latest news about Ray", "depends_on": []}, {"id": 3, "instruction": "Search the internet for the latest news about vLLM", "depends_on": []}, {"id": 4, "instruction": "Summarize the latest news about Kubernetes, Ray and vLLM", "depends_on": [1, 2, 3]}]}```
     """
 )
 
@@ -87,289 +112,1845 @@ CRITIC_PROMPT = (
     Previous step output: \n {last_output}"""
 )
 
-class Pipe:
-    class Valves(BaseModel):
-        SEARX_HOST: str = Field(default="http://127.0.0.1:8888")
-        TASK_MODEL_ID: str = Field(default="granite3.1-dense:8b")
-        OPENAI_API_URL: str = Field(default="http://localhost:11434/v1")
-        OPENAI_API_KEY: str = Field(default="ollama")
-        MODEL_TEMPERATURE: float = Field(default=0)
-        MAX_PLAN_STEPS: int = Field(default=6)
+CONTEXT_SUMMARY_PROMPT = (
+    """You maintain a running summary of the findings gathered so far while working through a plan. Merge the new findings into the existing summary.
+    Keep every fact, name, number, date and URL that could be needed later. Drop repetition and filler. Keep the updated summary under {max_words} words,
+    shortening the existing summary if needed. Reply only with the updated summary.
+    Existing summary: \n {summary} \n
+    New findings: \n {output}"""
+)
 
-    def __init__(self):
-        self.type = "pipe"
-        self.id = "granite_retrieval_agent"
-        self.name = "Granite Retrieval Agent"
-        self.valves = self.Valves()
+STEP_REVIEW_PROMPT = (
+    """You are an assistant that reviews each step of a plan as it is executed, in order to accomplish a given task.
+    You will receive json in the following format:
 
-    def get_provider_models(self):
-        return [
-            {"id": self.valves.TASK_MODEL_ID, "name": self.valves.TASK_MODEL_ID},
-        ]
+    {
+        "Goal": The original query from the user. Every time you create a reply, it must be guided by the task of fulfilling this goal. Do not veer off course.,
+        "Plan": An array that enumerates every step of the plan,
+        "Steps Taken": A sequential array of steps that have already been executed successfully before this one,
+        "Instruction": The step that was just executed,
+        "Assistant Output": The replies of the assistant that executed the instruction,
+    }
 
-    def is_open_webui_request(self, body):
-        # only look at last message
-        message = str(body[-1])
-        if "Create a concise, 3-5 word title with an emoji as a title for the chat history" in message or \
-                "Generate 1-3 broad tags categorizing the main themes of the chat history, along with 1-3 more specific subtopic tags." in message or \
-                    "You are an autocompletion system." in message:
-            return True
-        return False
+    Respond only with json in the following format and no additional text:
+    {"answer": ..., "accomplished": ..., "reason": ..., "next_step": ...}
 
-    async def emit_event_safe(self, message):
-        event_data = {
-                        "type": "message",
-                        "data": {"content": message + "\n"},
-                    }
-        try:
-            start_time = datetime.now()
-            await self.event_emitter(event_data)
-        except Exception as e:
-            logging.error(f"Error emitting event: {e}")
+    Instructions:
+        1. "answer": The assistant output will often contain the right information without directly answering the instruction. Directly answer the instruction using only the assistant output.
+        2. "accomplished": true if the answer completely satisfies the instruction, otherwise false. For example, if the instruction is to list companies that use AI, then the answer must contain a list of companies that use AI. If the output contains the phrase 'I'm sorry but...' then it is likely not fulfilling the instruction.
+        3. "reason": If the instruction was not accomplished, explain what went wrong. Otherwise an empty string.
+        4. "next_step": A single line of instruction for the next step to take. If the very last step of the plan has now been executed successfully, or the goal has already been achieved regardless of what step is next, then use the exact text: ##TERMINATE##
+           If the instruction was not accomplished and it is integral to solving the next step of the plan, do not move onto the next step. Instead, modify the instruction to find another way to achieve the step's objective in a way that won't repeat the same error.
+           Otherwise, always prefer the next sequential step in the plan.
 
-    def parse_response(self, message: str) -> dict[str, Any]:
+    Be persistent and resourceful to make sure you reach the goal.
+    """
+)
+
+ROUTER_PROMPT = (
+    """Decide whether the following query can be answered with a single search, either of the internet or of the user's documents, or whether it needs several steps such as multiple searches, combining information from different sources, or writing a longer document.
+    Reply only with ##SIMPLE## if a single search is enough, or ##COMPLEX## otherwise.
+    Query: {query}"""
+)
+
+CRITIC_JSON_FORMAT = (
+    """\n    Instead of replying with ##YES## or ##NO##, respond only with json in the following format and no additional text:
+    {"accomplished": true if the output completely satisfies the instruction otherwise false, "reason": why the output does not satisfy the instruction, or an empty string}"""
+)
+
+REFLECTION_JSON_FORMAT = (
+    """\n    Instead of a single line of instruction or ##TERMINATE##, respond only with json in the following format and no additional text:
+    {"terminate": true if there are no more steps to take otherwise false, "next_step": the single line of instruction for the next step, or an empty string}"""
+)
+
+class PlanStep(BaseModel):
+    id: int
+    instruction: str
+    depends_on: list[int]
+
+class Plan(BaseModel):
+    """
+    The structured reply of the planner, when structured output is enabled.
+    """
+    plan: list[PlanStep]
+
+class CriticVerdict(BaseModel):
+    """
+    The structured reply of the critic, when structured output is enabled.
+    """
+    accomplished: bool
+    reason: str
+
+class NextStep(BaseModel):
+    """
+    The structured reply of the reflection assistant, when structured output is enabled.
+    """
+    terminate: bool
+    next_step: str
+
+class StepReview(BaseModel):
+    """
+    The structured reply of the step reviewer, which stands in for the reformat, critic and reflection calls in the fast workflow.
+    """
+    answer: str
+    accomplished: bool
+    reason: str
+    next_step: str
+
+@lru_cache(maxsize=1)
+def load_token_encoding():
+    """
+    Load tiktoken's cl100k_base encoding. The first load downloads the encoding, with no timeout, so it must not run on the event loop.
+    """
+    try:
+        import tiktoken
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        logging.warning(f"Token encoding unavailable, estimating token counts from text length instead: {e}")
+        return None
+
+def count_tokens(text: str) -> int:
+    """
+    Count the tokens in text with tiktoken's cl100k_base encoding (installed with AutoGen). This is an approximation of
+    the Granite tokenizer, close enough for budgeting. Falls back to about four characters per token until the encoding
+    has been loaded in the background (see Pipe.get_agent_pool), or when it can't be loaded.
+    """
+    encoding = load_token_encoding() if load_token_encoding.cache_info().currsize else None
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """
+    Cut text down to at most max_tokens tokens, as counted by count_tokens.
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+    encoding = load_token_encoding() if load_token_encoding.cache_info().currsize else None
+    if encoding is None:
+        return text[: max(0, max_tokens) * 4]
+    return encoding.decode(encoding.encode(text, disallowed_special=())[: max(0, max_tokens)])
+
+class StepContext:
+    """
+    The outputs of successful plan steps, used as context for later steps and the final answer.
+    The most recent outputs are kept verbatim. Whenever the context exceeds its token budget, the oldest outputs
+    (including a single output that is over budget on its own) are folded one at a time into a rolling summary. The summary is
+    rewritten to fit within half of the budget each time, and cut short if the model overshoots, so the prompt size stays bounded
+    however long the plan runs.
+    """
+    def __init__(self, token_budget: int, summarize: Callable[[str, str, int], Awaitable[str]]):
+        self.token_budget = token_budget
+        self.summarize = summarize
+        self.summary = ""
+        self.outputs = []
+        self.uncompressed_tokens = 0  # What the context would cost had nothing been summarized
+
+    def __bool__(self):
+        return bool(self.summary or self.outputs)
+
+    @property
+    def summary_budget(self) -> int:
+        return max(1, self.token_budget // 2)
+
+    async def add(self, output: str):
+        self.outputs.append(output)
+        self.uncompressed_tokens += count_tokens(output)
+        while self.outputs and count_tokens(self.render()) > self.token_budget:
+            summary = await self.summarize(self.summary, self.outputs.pop(0), self.summary_budget)
+            self.summary = truncate_tokens(summary, self.summary_budget)
+
+    def copy(self, summarize: Optional[Callable[[str, str, int], Awaitable[str]]] = None) -> "StepContext":
         """
-        Parse the response from the planner and return the response as a dictionary.
-        """
-        # Parse the response content
-        json_response = {}
-        # if message starts with ``` and ends with ``` then remove them
-        if message.startswith("```"):
-            message = message[3:]
-        if message.endswith("```"):
-            message = message[:-3]
-        if message.startswith("json"):
-            message = message[4:]
-        if message.startswith("python"):
-            message = message[6:]
-        message = message.strip()
+        A copy of this context, already summarized as far as it is, that summarizes with the given function from here on.
+        """
+        context = StepContext(self.token_budget, summarize or self.summarize)
+        context.summary = self.summary
+        context.outputs = list(self.outputs)
+        context.uncompressed_tokens = self.uncompressed_tokens
+        return context
+
+    def render(self) -> str:
+        parts = []
+        if self.summary:
+            parts.append(f"Summary of earlier findings: {self.summary}")
+        parts.extend(self.outputs)
+        return "\n\n".join(parts)
+
+class LazyCodeExecutor:
+    """
+    Stands in for the local command line code executor, and only creates it (and its work dir) the first time code actually needs to run.
+    """
+    def __init__(self, **executor_args):
+        self.executor_args = executor_args
+        self.executor = None
+        self.extractor = coding.MarkdownCodeExtractor()
+
+    @property
+    def code_extractor(self):
+        return self.extractor
+
+    def execute_code_blocks(self, code_blocks):
+        if self.executor is None:
+            self.executor = coding.LocalCommandLineCodeExecutor(**self.executor_args)
+        return self.executor.execute_code_blocks(code_blocks)
+
+    def restart(self):
+        if self.executor is not None:
+            self.executor.restart()
+
+def find_closing_bracket(text: str, start: int) -> Optional[int]:
+    """
+    The index just past the bracket that closes the one at text[start], skipping over quoted strings.
+    """
+    depth = 0
+    quote = None
+    escaped = False
+    for index in range(start, len(text)):
+        char = text[index]
+        if quote:
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == quote:
+                quote = None
+        elif char in "\"'":
+            quote = char
+        elif char in "{[":
+            depth += 1
+        elif char in "}]":
+            depth -= 1
+            if depth == 0:
+                return index + 1
+    return None
+
+def extract_json(text: str, max_candidates: int = 16) -> Any:
+    """
+    Find and parse the first JSON object or array in an LLM reply, ignoring code fences and any text around it.
+    Python literals, such as single-quoted strings, are accepted too. Returns None when nothing parses.
+    """
+    decoder = json.JSONDecoder()
+    # Candidates are tried in the order they appear, so that a bare list of objects is returned whole rather than its first object
+    starts = [match.start() for match in re.finditer(r"[\[{]", text)]
+    for start in starts[:max_candidates]:
         try:
-            json_response: dict[str, Any] = json.loads(message)
-        except Exception as e:
-            # If the response is not a valid JSON, try pass it using string matching.
-            # This should seldom be triggered
-            print(f"LLM response was not properly formed JSON. Will try to use it as is. LLM response: \"{message}\". Error: {e}")
-            message = message.replace("\\n", "\n")
-            message = message.replace("\n", " ")  # type: ignore
-            if ("plan" in message and "next_step" in message):
-                start = message.index("plan") + len("plan")
-                end = message.index("next_step")
-                json_response["plan"] = message[start:end].replace('"', '').strip()
-
-        return json_response
+            # Decodes the value starting here and ignores whatever follows it
+            return decoder.raw_decode(text, start)[0]
+        except ValueError:
+            pass
+        end = find_closing_bracket(text, start)
+        if end is not None:
+            try:
+                value = ast.literal_eval(text[start:end])
+            except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+                continue
+            # Braces also make Python sets, which are not JSON
+            if isinstance(value, (dict, list)):
+                return value
+    return None
 
-    async def pipe(
-        self,
-        body,
-        __user__: Optional[dict] = None,
-        __event_emitter__: Callable[[dict], Awaitable[None]] = None,
-    ) -> str:
-
-        # Grab env variables
-        searx_host = self.valves.SEARX_HOST
-        default_model = self.valves.TASK_MODEL_ID
-        base_url = self.valves.OPENAI_API_URL
-        api_key = self.valves.OPENAI_API_KEY
-        model_temp = self.valves.MODEL_TEMPERATURE
-        max_plan_steps = self.valves.MAX_PLAN_STEPS
-        self.event_emitter = __event_emitter__
-
-        ##################
-        # AutoGen Config
-        ##################
-        # LLM Config
-        llm_config = {
-            "config_list": [{
-                "model": default_model,
-                "base_url": base_url,
-                "api_key": api_key,
-                "cache_seed": None,
-                "price": [0.0, 0.0],
-            }],
-            "temperature": model_temp,
+def tokenize(text: str) -> list[str]:
+    return re.findall(r"\w+", text.lower())
+
+def normalize_query(text: str) -> str:
+    """
+    Normalize a query for use as a cache key, so that differences in case and spacing don't cause misses.
+    Punctuation is kept, since it changes what a search means: C++ and C#, quoted phrases, or -excluded words.
+    """
+    return " ".join(text.lower().split())
+
+# Wording that suggests a query needs more than one lookup to answer
+COMPLEX_QUERY_PATTERN = re.compile(
+    r"\b(then|after|afterwards|finally|first|compare|comparison|versus|vs|each|every|all|both|between|steps?|plan|analy[sz]e|assess(ment)?|review|report|summari[sz]e|write|draft|create|study|figure out)\b|[,;:]"
+)
+
+# Wording that refers to the user's own documents, and wording that asks for information from the internet
+PERSONAL_QUERY_PATTERN = re.compile(r"\b(my|our|i'm|i am|me|notes|documents?|files?)\b")
+WEB_QUERY_PATTERN = re.compile(r"\b(latest|news|recent|current|today|internet|web|online)\b")
+
+def is_simple_query(query: str, max_words: int = 12) -> bool:
+    """
+    Heuristically decide whether a query is a short, single question that one search can answer, such as "What is vLLM?".
+    """
+    query = query.strip().lower()
+    if not query or len(query.split()) > max_words:
+        return False
+    # More than one sentence usually means more than one request
+    if len(re.findall(r"[.?!](\s|$)", query)) > 1:
+        return False
+    # Information from both the user's documents and the internet takes two searches
+    if PERSONAL_QUERY_PATTERN.search(query) and WEB_QUERY_PATTERN.search(query):
+        return False
+    return COMPLEX_QUERY_PATTERN.search(query) is None
+
+def bm25_scores(query: str, documents: list[str], k1: float = 1.5, b: float = 0.75) -> list[float]:
+    """
+    Score each document's relevance to the query with Okapi BM25, using the documents themselves as the corpus.
+    """
+    document_tokens = [tokenize(document) for document in documents]
+    if not document_tokens:
+        return []
+    average_length = sum(len(tokens) for tokens in document_tokens) / len(document_tokens) or 1
+    document_frequency = {}
+    for tokens in document_tokens:
+        for token in set(tokens):
+            document_frequency[token] = document_frequency.get(token, 0) + 1
+
+    scores = []
+    query_tokens = set(tokenize(query))
+    for tokens in document_tokens:
+        term_frequency = {}
+        for token in tokens:
+            term_frequency[token] = term_frequency.get(token, 0) + 1
+        score = 0.0
+        for token in query_tokens:
+            if token not in term_frequency:
+                continue
+            idf = math.log(1 + (len(document_tokens) - document_frequency[token] + 0.5) / (document_frequency[token] + 0.5))
+            frequency = term_frequency[token]
+            score += idf * frequency * (k1 + 1) / (frequency + k1 * (1 - b + b * len(tokens) / average_length))
+        scores.append(score)
+    return scores
+
+def select_knowledge_chunks(chunks: list[dict[str, Any]], top_k: int, max_chars: int) -> str:
+    """
+    Merge document chunks retrieved from several knowledge bases into one bounded result: the top_k most relevant chunks
+    (highest score first), without near-duplicates, each labelled with its source, and within max_chars characters in total.
+    """
+    selected = []
+    selected_tokens = []
+    total_chars = 0
+    for chunk in sorted(chunks, key=lambda chunk: chunk["score"], reverse=True):
+        if len(selected) >= top_k:
+            break
+        # Skip chunks that mostly repeat one already selected, e.g. the same passage in two knowledge bases
+        tokens = set(tokenize(chunk["content"]))
+        if any(len(tokens & other) >= 0.9 * max(len(tokens | other), 1) for other in selected_tokens):
+            continue
+        metadata = chunk["metadata"] or {}
+        text = f"[Source: {metadata.get('name') or metadata.get('source') or chunk['collection']}] {chunk['content']}"
+        if total_chars + len(text) > max_chars:
+            if selected:
+                continue
+            text = text[:max_chars]
+        selected.append(text)
+        selected_tokens.append(tokens)
+        total_chars += len(text)
+    return "\n\n".join(selected)
+
+class SQLiteCacheStore:
+    """
+    On-disk cache storage in a SQLite database, which every Open WebUI worker on the host can share.
+    Its methods block, for up to the lock timeout when other workers are writing, so they are meant to be called off the event loop.
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.schema_created = False
+
+    def connect(self) -> sqlite3.Connection:
+        # A connection per operation keeps the store safe to use from any thread
+        connection = sqlite3.connect(self.path, timeout=5)
+        if not self.schema_created:
+            with connection:
+                connection.execute("CREATE TABLE IF NOT EXISTS cache (namespace TEXT, key TEXT, value TEXT, expires_at REAL, PRIMARY KEY (namespace, key))")
+                # Expired entries are deleted on every write
+                connection.execute("CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at)")
+            self.schema_created = True
+        return connection
+
+    def get(self, namespace: str, key: str) -> Optional[tuple[str, float]]:
+        with self.connect() as connection:
+            row = connection.execute("SELECT value, expires_at FROM cache WHERE namespace = ? AND key = ? AND expires_at > ?", (namespace, key, time.time())).fetchone()
+        return row
+
+    def set(self, namespace: str, key: str, value: str, expires_at: float, max_entries: int):
+        with self.connect() as connection:
+            connection.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)", (namespace, key, value, expires_at))
+            connection.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+            # Keep the namespace within its size limit by dropping the entries closest to expiring
+            connection.execute("DELETE FROM cache WHERE namespace = ? AND key IN (SELECT key FROM cache WHERE namespace = ? ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+                               (namespace, namespace, max_entries))
+
+class TTLCache:
+    """
+    A size-bounded LRU cache whose entries expire after a time to live. When given an on-disk store, entries are written through
+    to it, and misses in memory are looked up there, so results can be shared across workers and restarts.
+    Store operations are run with run_blocking (by default on a worker thread) so they never block the event loop.
+    """
+    def __init__(self, namespace: str, max_entries: int, ttl_seconds: float, store: Optional[SQLiteCacheStore] = None,
+                 run_blocking: Optional[Callable[..., Awaitable[Any]]] = None):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.store = store
+        self.run_blocking = run_blocking or asyncio.to_thread
+        self.entries = OrderedDict()  # Key -> (value, expires_at), least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, key: str) -> Optional[str]:
+        if self.ttl_seconds <= 0:
+            return None
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] <= time.time():
+            del self.entries[key]
+            entry = None
+        if entry is None and self.store is not None:
+            entry = await self.run_blocking(self.store.get, self.namespace, key)
+            if entry is not None:
+                self.remember(key, entry)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    async def set(self, key: str, value: str):
+        if self.ttl_seconds <= 0:
+            return
+        entry = (value, time.time() + self.ttl_seconds)
+        self.remember(key, entry)
+        if self.store is not None:
+            await self.run_blocking(self.store.set, self.namespace, key, value, entry[1], self.max_entries)
+
+    def remember(self, key: str, entry: tuple[str, float]):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0, "entries": len(self.entries)}
+
+# Words that carry little meaning, left out when comparing queries
+STOPWORDS = {"a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in", "is", "it", "of", "on", "or", "please", "that", "the", "to", "with"}
+
+def query_terms(text: str) -> set[str]:
+    """
+    The lowercased, whitespace-separated words of a query, without stopwords or surrounding punctuation.
+    Punctuation inside a word is kept, so C++ and C# stay different words from C.
+    """
+    terms = {term.strip(".,;:!?\"'()[]{}") for term in text.lower().split()}
+    return terms - STOPWORDS - {""}
+
+class PlanCache:
+    """
+    Plans made for earlier queries, so that a query the same as, or very similar to, one the user asked before can reuse its plan.
+    Queries are matched by their normalized text, then by the overlap of their words (Jaccard similarity). A similar query only matches
+    when none of the words the two queries don't share appear in the plan, so that a plan made for another person or topic is never reused.
+    Plans are kept in memory, separately for each user, expire after a time to live, and the least recently used are evicted beyond max_entries.
+    """
+    def __init__(self, max_entries: int, ttl_seconds: float, similarity_threshold: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.entries = OrderedDict()  # (user id, normalized query) -> (plan graph, query terms, plan terms, expires_at), least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: str, query: str) -> Optional[list[dict[str, Any]]]:
+        if self.ttl_seconds <= 0:
+            return None
+        now = time.time()
+        for key in [key for key, entry in self.entries.items() if entry[3] <= now]:
+            del self.entries[key]
+
+        match = (user_id, normalize_query(query))
+        if match not in self.entries:
+            match = None
+            terms = query_terms(query)
+            best_similarity = self.similarity_threshold
+            for key, (_, entry_terms, plan_terms, _) in self.entries.items():
+                if key[0] != user_id or not terms or (terms ^ entry_terms) & plan_terms:
+                    continue
+                similarity = len(terms & entry_terms) / len(terms | entry_terms)
+                if similarity >= best_similarity:
+                    match, best_similarity = key, similarity
+        if match is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(match)
+        self.hits += 1
+        # Steps are dicts, so hand out a copy the caller is free to modify
+        return json.loads(json.dumps(self.entries[match][0]))
+
+    def set(self, user_id: str, query: str, plan_graph: list[dict[str, Any]]):
+        if self.ttl_seconds <= 0:
+            return
+        key = (user_id, normalize_query(query))
+        plan_terms = query_terms(" ".join(step["instruction"] for step in plan_graph))
+        self.entries[key] = (json.loads(json.dumps(plan_graph)), query_terms(query), plan_terms, time.time() + self.ttl_seconds)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0, "entries": len(self.entries)}
+
+class SearxClient:
+    """
+    Queries SearXNG over one pooled HTTP session, instead of opening a new session for every search, with the raw results cached by search term.
+    Host and parameter handling, and the formatting of results, follow SearxSearchWrapper.
+    """
+    def __init__(self, searx_host: str, result_cache: TTLCache):
+        self.wrapper = SearxSearchWrapper(searx_host=searx_host)
+        self.result_cache = result_cache
+        self.session = None
+        self.session_loop = None
+
+    def get_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        if self.session is None or self.session.closed or self.session_loop is not loop:
+            self.session = aiohttp.ClientSession()
+            self.session_loop = loop
+        return self.session
+
+    async def query(self, query: str) -> SearxResults:
+        cache_key = normalize_query(query)
+        cached = await self.result_cache.get(cache_key)
+        if cached is not None:
+            return SearxResults(cached)
+
+        request_args = {"headers": self.wrapper.headers, "params": {**self.wrapper.params, "q": query}}
+        if self.wrapper.unsecure:
+            request_args["ssl"] = False
+        async with self.get_session().get(self.wrapper.searx_host, **request_args) as response:
+            if not response.ok:
+                raise ValueError("Searx API returned an error: ", await response.text())
+            raw_results = await response.text()
+        await self.result_cache.set(cache_key, raw_results)
+        return SearxResults(raw_results)
+
+    async def run(self, query: str) -> str:
+        results = await self.query(query)
+        if len(results.answers) > 0:
+            return results.answers[0]
+        if len(results.results) > 0:
+            return "\n\n".join([result.get("content", "") for result in results.results[: self.wrapper.k]])
+        return "No good search result found"
+
+    async def run_many(self, queries: list[str], rank_query: str, top_k: int) -> str:
+        """
+        Run several queries concurrently, then remove duplicate results (by URL and by content) and
+        return only the top_k results most relevant to rank_query. Queries that fail are skipped, unless they all do.
+        """
+        responses = await asyncio.gather(*[self.query(query) for query in queries], return_exceptions=True)
+        errors = [response for response in responses if isinstance(response, Exception)]
+        for query, response in zip(queries, responses):
+            if isinstance(response, Exception):
+                logging.error(f"Error searching Searx for {query}: {response}")
+        if len(errors) == len(responses):
+            raise errors[0]
+        responses = [response for response in responses if not isinstance(response, Exception)]
+
+        answers = []
+        candidates = []
+        seen_urls = set()
+        seen_contents = set()
+        for response in responses:
+            answers.extend(answer for answer in response.answers if answer not in answers)
+            for result in response.results:
+                url = urlsplit(result.get("url", ""))
+                url_key = (url.netloc.lower() + url.path.rstrip("/") + "?" + url.query) if url.netloc else ""
+                content_key = hashlib.sha1(" ".join(tokenize(result.get("content", ""))).encode()).hexdigest()
+                if (url_key and url_key in seen_urls) or content_key in seen_contents:
+                    continue
+                seen_urls.add(url_key)
+                seen_contents.add(content_key)
+                candidates.append(result)
+
+        if not answers and not candidates:
+            return "No good search result found"
+        scores = bm25_scores(rank_query, [f"{result.get('title', '')} {result.get('content', '')}" for result in candidates])
+        ranked = [result for _, result in sorted(zip(scores, candidates), key=lambda pair: pair[0], reverse=True)]
+        snippets = answers + [f"{result.get('title', '')}: {result.get('content', '')} (Source: {result.get('url', '')})" for result in ranked[:top_k]]
+        return "\n\n".join(snippets)
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+class Span:
+    """
+    A timed stage of a request, such as a plan step, a chat between two agents, an LLM call or a tool call.
+    Spans nest, and carry attributes such as the tokens used by an LLM call or the number of times a step was retried.
+    """
+    def __init__(self, name: str, trace_id: Optional[str] = None, parent: Optional["Span"] = None, attributes: Optional[dict[str, Any]] = None):
+        self.name = name
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = dict(attributes or {})
+        self.children = []
+        self.start_time = time.time()
+        self.started_at = time.perf_counter()
+        self.duration = None
+
+    def child(self, name: str, **attributes) -> "Span":
+        span = Span(name, self.trace_id, self, attributes)
+        self.children.append(span)
+        return span
+
+    def add(self, attribute: str, value: float = 1):
+        self.attributes[attribute] = self.attributes.get(attribute, 0) + value
+
+    def finish(self):
+        if self.duration is None:
+            self.duration = time.perf_counter() - self.started_at
+
+    def walk(self):
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    def total(self, attribute: str) -> float:
+        """
+        Sum an attribute over this span and every span nested in it.
+        """
+        return sum(span.attributes.get(attribute, 0) for span in self.walk())
+
+    def to_dict(self) -> dict[str, Any]:
+        # Field names follow the OpenTelemetry span model, so the exported lines are easy to load into tracing tools
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_span_id": self.parent_id,
+            "name": self.name,
+            "start_time": self.start_time,
+            "end_time": self.start_time + (self.duration or 0),
+            "duration_ms": round((self.duration or 0) * 1000, 1),
+            "attributes": self.attributes,
         }
 
+def format_timing_summary(root: Span) -> str:
+    """
+    A compact, collapsed breakdown of where a request spent its time and tokens, for display at the end of the answer.
+    """
+    def tokens(span):
+        return int(span.total("prompt_tokens") + span.total("completion_tokens"))
+
+    retries = int(root.total("retries"))
+    lines = [
+        "<details>",
+        f"<summary>Timing: {root.duration or 0:.1f}s, {int(root.total('llm_calls'))} LLM calls, {int(root.total('prompt_tokens')):,} prompt + {int(root.total('completion_tokens')):,} completion tokens"
+        + (f", {retries} step retries" if retries else "") + "</summary>",
+        "",
+        "| Stage | Time | LLM calls | Tokens |",
+        "|---|---|---|---|",
+    ]
+    for span in root.children:
+        label = span.name
+        if "instruction" in span.attributes:
+            instruction = str(span.attributes["instruction"])
+            label += ": " + (instruction[:60] + "..." if len(instruction) > 60 else instruction)
+        if span.attributes.get("retries"):
+            label += f" ({span.attributes['retries']} retries)"
+        if span.attributes.get("accomplished") is False:
+            label += " (not accomplished)"
+        lines.append(f"| {label} | {span.duration or 0:.1f}s | {int(span.total('llm_calls'))} | {tokens(span):,} |")
+
+    # Time spent in each tool, across all steps
+    tools = {}
+    for span in root.walk():
+        if span.name.startswith("tool:"):
+            calls, seconds = tools.get(span.name[5:], (0, 0.0))
+            tools[span.name[5:]] = (calls + 1, seconds + (span.duration or 0))
+    if tools:
+        lines.append("")
+        lines.append("Tools: " + ", ".join(f"{name} {seconds:.1f}s ({calls} calls)" for name, (calls, seconds) in tools.items()))
+    lines.append("</details>")
+    return "\n".join(lines)
+
+def export_opentelemetry_spans(root: Span):
+    """
+    Replay a finished trace through the OpenTelemetry tracer provider configured in the host application, if the package is installed.
+    """
+    try:
+        from opentelemetry import trace
+    except ImportError:
+        logging.warning("OpenTelemetry export is enabled but the opentelemetry package is not installed")
+        return
+    tracer = trace.get_tracer("granite_retrieval_agent")
+
+    def replay(span, context):
+        attributes = {name: value for name, value in span.attributes.items() if isinstance(value, (str, bool, int, float))}
+        otel_span = tracer.start_span(span.name, context=context, start_time=int(span.start_time * 1e9), attributes=attributes)
+        for child in span.children:
+            replay(child, trace.set_span_in_context(otel_span))
+        otel_span.end(end_time=int((span.start_time + (span.duration or 0)) * 1e9))
+
+    replay(root, None)
+
+class AgentTeam:
+    """
+    The agents that collaborate on a request. AutoGen agents keep per-conversation state,
+    so every plan step that runs concurrently with another needs a team of its own.
+    """
+    def __init__(self, llm_config: dict[str, Any], structured_output: bool = False):
+        # With structured output, the planner, critic and reflection assistant ask the endpoint for replies that follow a JSON schema
+        def structured_llm_config(response_format):
+            return {**llm_config, "response_format": response_format} if structured_output else llm_config
+
         # Generic Assistant - Used for general inquiry. Does not call tools.
-        generic_assistant = ConversableAgent(
+        self.generic_assistant = ConversableAgent(
             name="Generic_Assistant",
             llm_config=llm_config,
             human_input_mode="NEVER"
         )
 
         # Provides the initial high level plan
-        planner = ConversableAgent(
+        self.planner = ConversableAgent(
             name="Planner",
             system_message=PLANNER_MESSAGE,
-            llm_config=llm_config,
+            llm_config=structured_llm_config(Plan),
             human_input_mode="NEVER"
         )
 
         # The assistant agent is responsible for executing each step of the plan, including calling tools
-        assistant = ConversableAgent(
+        self.assistant = ConversableAgent(
             name="Research_Assistant",
             system_message=ASSISTANT_PROMPT,
             llm_config=llm_config,
             human_input_mode="NEVER",
-            is_termination_msg=lambda msg: "tool_response" not in msg and msg["content"] == ""
+            is_termination_msg=lambda msg: "tool_response" not in msg and "tool_calls" not in msg and msg["content"] == ""
         )
 
         # Reflection Assistant: Reflect on plan progress and give the next step
-        reflection_assistant = ConversableAgent(
+        self.reflection_assistant = ConversableAgent(
             name="ReflectionAssistant",
             system_message=REFLECTION_ASSISTANT_PROMPT,
-            llm_config=llm_config,
+            llm_config=structured_llm_config(NextStep),
+            human_input_mode="NEVER"
+        )
+
+        # Critic: Judges whether a step's output satisfies its instruction
+        self.critic = ConversableAgent(
+            name="Critic",
+            llm_config=structured_llm_config(CriticVerdict),
+            human_input_mode="NEVER"
+        )
+
+        # Step Reviewer: Used by the fast workflow. Reformats a step's output, judges it and decides the next step in one structured reply
+        self.step_reviewer = ConversableAgent(
+            name="StepReviewer",
+            system_message=STEP_REVIEW_PROMPT,
+            llm_config={**llm_config, "response_format": StepReview},
             human_input_mode="NEVER"
         )
 
         # User Proxy chats with assistant on behalf of user and executes tools
-        code_exec = coding.LocalCommandLineCodeExecutor(
+        code_exec = LazyCodeExecutor(
             timeout=10,
             work_dir="code_exec",
         )
-        user_proxy = ConversableAgent(
+        self.user_proxy = ConversableAgent(
             name="User",
             human_input_mode="NEVER",
             code_execution_config={"executor": code_exec},
             is_termination_msg=lambda msg: "##SUMMARY##" in msg["content"] or "## Summary" in msg["content"] or "##TERMINATE##" in msg["content"] or ("tool_calls" not in msg and msg["content"] == "")
         )
 
-        ##################
-        # Check if this request is utility call from OpenWebUI
-        ##################
-        if self.is_open_webui_request(body["messages"]):
-            print("Is open webui request")
-            reply = generic_assistant.generate_reply(messages=[body['messages'][-1]])
-            return reply
-
-        ##################
-        # Tool Definitions
-        ##################
-        @assistant.register_for_llm(name="web_search", description="Searches the web according to a given query")
+class AgentPool:
+    """
+    Long-lived, pre-configured agent teams and HTTP clients, all built from one snapshot of the valves.
+    Teams are checked out for the duration of a request (or plan step) and returned afterwards for reuse.
+    Requests hold the pool from acquire to release, so that a pool retired after a valve change is only closed once no request is using it.
+    """
+    def __init__(self, create_team: Callable[[], AgentTeam], utility_assistant: ConversableAgent, searx_client: SearxClient, openai_client: AsyncOpenAI,
+                 caches: dict[str, TTLCache | PlanCache], max_idle_teams: int):
+        self.create_team = create_team
+        # Answers Open WebUI's title, tag and autocomplete requests. It is only ever used through generate_reply with explicit messages, so it can be shared
+        self.utility_assistant = utility_assistant
+        self.searx_client = searx_client
+        # Used directly, rather than through an agent, for the replies that are streamed to the user
+        self.openai_client = openai_client
+        self.caches = caches
+        self.max_idle_teams = max_idle_teams
+        self.idle_teams = []
+        self.requests = 0
+        self.retired = False
+
+    @asynccontextmanager
+    async def team(self):
+        team = self.idle_teams.pop() if self.idle_teams else self.create_team()
+        yield team
+        # A team is only returned to the pool when the request using it finished cleanly
+        if not self.retired and len(self.idle_teams) < self.max_idle_teams:
+            self.idle_teams.append(team)
+
+    def acquire(self) -> "AgentPool":
+        self.requests += 1
+        return self
+
+    async def release(self):
+        self.requests -= 1
+        if self.retired and self.requests == 0:
+            await self.close()
+
+    async def retire(self):
+        """
+        Stop handing out this pool's teams, and close its HTTP clients once the last request using it is released.
+        """
+        self.retired = True
+        if self.requests == 0:
+            await self.close()
+
+    def cache_stats(self) -> dict[str, dict[str, Any]]:
+        return {name: cache.stats() for name, cache in self.caches.items()}
+
+    async def close(self):
+        self.idle_teams = []
+        await self.searx_client.close()
+        await self.openai_client.close()
+
+# Priority lanes of the LLM scheduler, most urgent first
+LANE_UTILITY = 0  # Open WebUI's title, tag and autocomplete requests
+LANE_FINAL_ANSWER = 1  # The answer the user is waiting on
+LANE_PLAN_STEPS = 2  # Planning, and executing and reviewing plan steps
+LANE_NAMES = {LANE_UTILITY: "utility", LANE_FINAL_ANSWER: "final_answer", LANE_PLAN_STEPS: "plan_steps"}
+
+class LLMScheduler:
+    """
+    Admission control in front of the LLM backend, shared by every request the pipe serves. At most max_concurrency calls
+    run at once (0 for no limit); the rest wait, and are admitted by lane priority, then in order of arrival.
+    Identical calls that overlap can be coalesced, so that only the first reaches the backend and the others share its reply.
+    """
+    def __init__(self, max_concurrency: int):
+        self.max_concurrency = max_concurrency
+        self.active = 0
+        self.waiting = []  # Heap of (lane, arrival, future)
+        self.arrivals = 0
+        self.in_flight = {}  # Coalescing key -> task of the call
+        self.coalesced = 0
+        self.lane_stats = {lane: {"waiting": 0, "max_waiting": 0, "admitted": 0, "total_wait_seconds": 0.0, "max_wait_seconds": 0.0} for lane in LANE_NAMES}
+
+    def has_capacity(self) -> bool:
+        return self.max_concurrency <= 0 or self.active < self.max_concurrency
+
+    def set_limit(self, max_concurrency: int):
+        self.max_concurrency = max_concurrency
+        self.dispatch()
+
+    def dispatch(self):
+        # Hand free slots to the highest priority waiters
+        while self.waiting and self.has_capacity():
+            _, _, future = heapq.heappop(self.waiting)
+            if future.done():
+                # Its waiter was cancelled
+                continue
+            self.active += 1
+            future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, lane: int, span: Optional[Span] = None):
+        """
+        Wait for a slot in the lane, and hold it for the duration of the block. The wait is recorded on the span, or the current span.
+        """
+        started_at = time.perf_counter()
+        stats = self.lane_stats[lane]
+        if self.has_capacity() and not self.waiting:
+            self.active += 1
+        else:
+            entry = (lane, self.arrivals, asyncio.get_running_loop().create_future())
+            self.arrivals += 1
+            heapq.heappush(self.waiting, entry)
+            stats["waiting"] += 1
+            stats["max_waiting"] = max(stats["max_waiting"], stats["waiting"])
+            try:
+                # The slot is taken on our behalf when the future is resolved
+                await entry[2]
+            except asyncio.CancelledError:
+                if entry[2].done() and not entry[2].cancelled():
+                    self.release()
+                elif entry in self.waiting:
+                    self.waiting.remove(entry)
+                    heapq.heapify(self.waiting)
+                raise
+            finally:
+                stats["waiting"] -= 1
+        waited = time.perf_counter() - started_at
+        stats["admitted"] += 1
+        stats["total_wait_seconds"] += waited
+        stats["max_wait_seconds"] = max(stats["max_wait_seconds"], waited)
+        span = span or _current_span.get()
+        if span is not None:
+            span.add("queue_wait_seconds", waited)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def release(self):
+        self.active -= 1
+        self.dispatch()
+
+    async def run(self, lane: int, call: Callable[[], Awaitable[Any]], coalescing_key: Optional[str] = None) -> tuple[Any, bool]:
+        """
+        Run call() once a slot in the lane is free, and return its result and whether the result was shared from an identical call already in flight.
+        """
+        if coalescing_key is not None and coalescing_key in self.in_flight:
+            self.coalesced += 1
+            return await asyncio.shield(self.in_flight[coalescing_key]), True
+
+        async def admitted():
+            async with self.slot(lane):
+                return await call()
+
+        if coalescing_key is None:
+            return await admitted(), False
+        # The call runs as its own task, so that it completes for the calls sharing it even if this one is cancelled
+        task = asyncio.ensure_future(admitted())
+        self.in_flight[coalescing_key] = task
+        task.add_done_callback(lambda _: self.in_flight.pop(coalescing_key) if self.in_flight.get(coalescing_key) is task else None)
+        return await asyncio.shield(task), False
+
+    def stats(self) -> dict[str, Any]:
+        lanes = {}
+        for lane, stats in self.lane_stats.items():
+            lanes[LANE_NAMES[lane]] = {
+                "waiting": stats["waiting"],
+                "max_waiting": stats["max_waiting"],
+                "admitted": stats["admitted"],
+                "avg_wait_seconds": stats["total_wait_seconds"] / stats["admitted"] if stats["admitted"] else 0.0,
+                "max_wait_seconds": stats["max_wait_seconds"],
+            }
+        return {"active": self.active, "limit": self.max_concurrency, "coalesced": self.coalesced, "lanes": lanes}
+
+# The event emitter belongs to a single pipe invocation. Open WebUI shares one Pipe instance across all chats,
+# so it is tracked per request (per asyncio task) rather than on the instance.
+_request_event_emitter: ContextVar[Optional[Callable[[dict], Awaitable[None]]]] = ContextVar("request_event_emitter", default=None)
+_request_user: ContextVar[Optional[dict]] = ContextVar("request_user", default=None)
+# The innermost span of the request's trace that is in progress, which new spans are nested under
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+# The scheduler lane of the LLM calls the request is making
+_llm_lane: ContextVar[int] = ContextVar("llm_lane", default=LANE_PLAN_STEPS)
+
+# The valves an agent pool, its teams, HTTP clients and caches are built from. Changing any other valve keeps the warm pool and its caches
+AGENT_POOL_VALVES = {
+    "SEARX_HOST", "TASK_MODEL_ID", "OPENAI_API_URL", "OPENAI_API_KEY", "MODEL_TEMPERATURE", "AGENT_POOL_SIZE", "STRUCTURED_OUTPUT",
+    "SEARCH_CACHE_TTL_SECONDS", "SEARCH_CACHE_MAX_ENTRIES", "SEARCH_CACHE_PATH", "KNOWLEDGE_BASE_CACHE_SECONDS",
+    "PLAN_CACHE_TTL_SECONDS", "PLAN_CACHE_MAX_ENTRIES", "PLAN_CACHE_SIMILARITY",
+}
+
+class Pipe:
+    class Valves(BaseModel):
+        SEARX_HOST: str = Field(default="http://127.0.0.1:8888")
+        TASK_MODEL_ID: str = Field(default="granite3.1-dense:8b")
+        OPENAI_API_URL: str = Field(default="http://localhost:11434/v1")
+        OPENAI_API_KEY: str = Field(default="ollama")
+        MODEL_TEMPERATURE: float = Field(default=0)
+        MAX_PLAN_STEPS: int = Field(default=6)
+        CONTEXT_TOKEN_BUDGET: int = Field(default=4000, description="Token budget for the findings of earlier steps that are passed to each step and the final answer. Older findings are summarized to stay within it")
+        FAST_WORKFLOW: bool = Field(default=False, description="Review each step with a single structured LLM call instead of separate reformat, critic and reflection calls")
+        MAX_PARALLEL_STEPS: int = Field(default=4, description="How many independent plan steps may execute at the same time. 1 always executes the plan one step at a time")
+        AGENT_POOL_SIZE: int = Field(default=4, description="How many idle agent teams to keep warm for reuse across requests")
+        WEB_SEARCH_QUERIES: int = Field(default=1, description="How many search term variants each web search runs concurrently. Above 1, results are deduplicated and reranked against the instruction")
+        WEB_SEARCH_TOP_K: int = Field(default=5, description="How many web search results are returned to the model when running several search term variants")
+        KNOWLEDGE_BASE_CACHE_SECONDS: int = Field(default=300, description="How long each user's list of knowledge bases is cached for. 0 looks it up on every search")
+        KNOWLEDGE_PER_COLLECTION_K: int = Field(default=4, description="How many document chunks to retrieve from each knowledge base")
+        KNOWLEDGE_TOP_K: int = Field(default=8, description="How many document chunks, across all knowledge bases, are returned to the model")
+        KNOWLEDGE_MAX_CHARS: int = Field(default=6000, description="Character limit for the document search results returned to the model")
+        SEARCH_CACHE_TTL_SECONDS: int = Field(default=3600, description="How long search terms and web search results are cached for. 0 disables the cache")
+        SEARCH_CACHE_MAX_ENTRIES: int = Field(default=512, description="How many search terms, and how many web search results, the cache holds")
+        SEARCH_CACHE_PATH: str = Field(default="", description="Path of a SQLite file to also keep the search cache in, shared by all workers. Leave empty to cache in memory only")
+        PLAN_CACHE_TTL_SECONDS: int = Field(default=604800, description="How long the plans of successful requests are kept for reuse by similar requests from the same user. 0 disables the plan cache")
+        PLAN_CACHE_MAX_ENTRIES: int = Field(default=256, description="How many plans the plan cache holds, across all users")
+        PLAN_CACHE_SIMILARITY: float = Field(default=0.9, description="How similar (0 to 1, by the share of words in common) a query must be to an earlier one to reuse its plan")
+        STRUCTURED_OUTPUT: bool = Field(default=False, description="Ask the endpoint for JSON that follows a schema (json_schema response format) for the planner, critic and reflection replies, instead of free text with markers")
+        STRUCTURED_OUTPUT_RETRIES: int = Field(default=1, description="How many times to retry a planner, critic, reflection or step review call whose reply could not be parsed")
+        STREAM_FINAL_ANSWER: bool = Field(default=False, description="Stream the final answer to the chat token by token as it is generated")
+        STREAM_STEP_OUTPUTS: bool = Field(default=False, description="Also stream each step's answer to the chat as it is generated. Not used by the fast workflow, or for steps that run concurrently, whose answers would interleave")
+        MAX_CONCURRENT_LLM_CALLS: int = Field(default=8, description="How many LLM calls, across all chats, may run against the backend at once. Waiting calls are admitted in priority order: Open WebUI's title and tag requests, then final answers, then plan steps. 0 for no limit")
+        COALESCE_LLM_CALLS: bool = Field(default=True, description="Let identical critic, reformat and other tool-free LLM calls that are in flight at the same time share one backend request")
+        MAX_IO_WORKERS: int = Field(default=16, description="Size of the thread pool that runs blocking LLM and tool I/O off the event loop")
+        TRACE_FILE: str = Field(default="", description="Path of a JSON lines file to append the trace of every request to, one span per line. Leave empty to not export traces")
+        TRACE_OPENTELEMETRY: bool = Field(default=False, description="Also export the trace of every request through OpenTelemetry, when the opentelemetry package is installed")
+        QUERY_ROUTER: str = Field(default="heuristic", description="How to pick out simple queries, which are answered with a single assistant turn instead of a plan: heuristic (no LLM call), llm (one short LLM call) or off")
+        SHOW_TIMING_SUMMARY: bool = Field(default=False, description="Add a collapsed breakdown of where the time and tokens went to the end of each answer")
+
+    def __init__(self):
+        self.type = "pipe"
+        self.id = "granite_retrieval_agent"
+        self.name = "Granite Retrieval Agent"
+        self.valves = self.Valves()
+        self.io_executor = None
+        self.io_executor_workers = 0
+        self.agent_pool = None
+        self.agent_pool_valves = None
+        self.token_encoding_task = None
+        self.llm_scheduler = LLMScheduler(self.valves.MAX_CONCURRENT_LLM_CALLS)
+        # How many JSON replies were parsed, rescued from surrounding text, retried, or given up on
+        self.structured_output_stats = {"replies": 0, "rescued": 0, "retried": 0, "failed": 0}
+
+    def get_provider_models(self):
+        return [
+            {"id": self.valves.TASK_MODEL_ID, "name": self.valves.TASK_MODEL_ID},
+        ]
+
+    def is_open_webui_request(self, body):
+        # only look at last message
+        message = str(body[-1])
+        if "Create a concise, 3-5 word title with an emoji as a title for the chat history" in message or \
+                "Generate 1-3 broad tags categorizing the main themes of the chat history, along with 1-3 more specific subtopic tags." in message or \
+                    "You are an autocompletion system." in message:
+            return True
+        return False
+
+    async def emit_event_safe(self, message, end="\n"):
+        event_emitter = _request_event_emitter.get()
+        if event_emitter is None:
+            return
+        event_data = {
+                        "type": "message",
+                        "data": {"content": message + end},
+                    }
+        try:
+            start_time = time.perf_counter()
+            await event_emitter(event_data)
+            # Status messages are sent to the browser as they happen, so time spent on them is counted in the trace
+            span = _current_span.get()
+            if span is not None:
+                span.add("emit_seconds", time.perf_counter() - start_time)
+        except Exception as e:
+            logging.error(f"Error emitting event: {e}")
+
+    @asynccontextmanager
+    async def trace_span(self, name: str, **attributes):
+        """
+        Time a stage of the request as a span nested in the current one. Outside of a traced request, this yields None and records nothing.
+        """
+        parent = _current_span.get()
+        if parent is None:
+            yield None
+            return
+        span = parent.child(name, **attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        finally:
+            span.finish()
+            _current_span.reset(token)
+
+    async def finish_trace(self, root: Span) -> str:
+        """
+        End the request's trace and export it as the valves ask. Returns the timing summary to show in the chat, if enabled.
+        """
+        root.finish()
+        logging.info(f"Request took {root.duration:.2f}s with {int(root.total('llm_calls'))} LLM calls, "
+                     f"{int(root.total('prompt_tokens'))} prompt and {int(root.total('completion_tokens'))} completion tokens")
+        if self.valves.TRACE_FILE:
+            lines = "".join(json.dumps(span.to_dict(), default=str) + "\n" for span in root.walk())
+            try:
+                await self.run_blocking(self.append_to_file, self.valves.TRACE_FILE, lines)
+            except Exception as e:
+                logging.error(f"Error exporting trace: {e}")
+        if self.valves.TRACE_OPENTELEMETRY:
+            export_opentelemetry_spans(root)
+        if self.valves.SHOW_TIMING_SUMMARY:
+            return "\n\n" + format_timing_summary(root)
+        return ""
+
+    def append_to_file(self, path: str, text: str):
+        with open(path, "a", encoding="utf-8") as file:
+            file.write(text)
+
+    async def chat(self, name: str, sender: ConversableAgent, recipient: ConversableAgent, message, max_turns: int):
+        """
+        Run a chat between two agents as a span of the request's trace, and return the chat result.
+        """
+        async with self.trace_span(name, agent=recipient.name):
+            return await sender.a_initiate_chat(recipient=recipient, message=message, max_turns=max_turns)
+
+    async def run_blocking(self, func, *args, **kwargs):
+        """
+        Run a blocking call on a bounded thread pool so it does not stall the Open WebUI event loop.
+        """
+        if self.io_executor is None or self.io_executor_workers != self.valves.MAX_IO_WORKERS:
+            # (Re)create the pool when first used or when the valve has changed
+            if self.io_executor is not None:
+                self.io_executor.shutdown(wait=False)
+            self.io_executor_workers = self.valves.MAX_IO_WORKERS
+            self.io_executor = ThreadPoolExecutor(max_workers=self.io_executor_workers, thread_name_prefix="granite_agent_io")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.io_executor, partial(func, *args, **kwargs))
+
+    def offload_llm_replies(self, agent: ConversableAgent, coalesce: bool = False):
+        """
+        Route an agent's LLM calls through the shared LLM scheduler, and run them on the bounded I/O pool instead of the event loop's
+        default executor, so concurrent chats are not capped by the size of the host application's default pool.
+        With coalesce, a call identical to one already in flight shares its reply. Only use it for agents that don't call tools.
+        """
+        async def a_generate_oai_reply(recipient, messages=None, sender=None, config=None):
+            call = partial(self.run_blocking, recipient.generate_oai_reply, messages=messages, sender=sender, config=config)
+            coalescing_key = None
+            if coalesce and self.valves.COALESCE_LLM_CALLS and messages is not None:
+                coalescing_key = hashlib.sha1(json.dumps([recipient.llm_config, recipient.system_message, messages], sort_keys=True, default=str).encode()).hexdigest()
+            async with self.trace_span("llm", agent=recipient.name) as span:
+                if span is None:
+                    reply, coalesced = await self.llm_scheduler.run(_llm_lane.get(), call, coalescing_key)
+                    return copy.deepcopy(reply) if coalesced else reply
+                # Each agent belongs to one request at a time, so the change in its client's usage is this call's usage
+                prompt_tokens, completion_tokens = self.llm_usage(recipient)
+                reply, coalesced = await self.llm_scheduler.run(_llm_lane.get(), call, coalescing_key)
+                usage = self.llm_usage(recipient)
+                if coalesced:
+                    span.attributes["coalesced"] = True
+                    reply = copy.deepcopy(reply)
+                else:
+                    span.add("llm_calls")
+                span.add("prompt_tokens", usage[0] - prompt_tokens)
+                span.add("completion_tokens", usage[1] - completion_tokens)
+                return reply
+
+        agent.replace_reply_func(ConversableAgent.a_generate_oai_reply, a_generate_oai_reply)
+
+    def traced_tool(self, name: str):
+        """
+        Decorate an async tool function so each call is a span of the request's trace. The function's signature is kept for tool registration.
+        """
+        def decorator(func):
+            @wraps(func)
+            async def traced(*args, **kwargs):
+                async with self.trace_span(f"tool:{name}", **{argument: str(value) for argument, value in kwargs.items()}):
+                    return await func(*args, **kwargs)
+            return traced
+        return decorator
+
+    def llm_usage(self, agent: ConversableAgent) -> tuple[int, int]:
+        """
+        The prompt and completion tokens an agent has used so far, as reported by the endpoint.
+        """
+        usage_summary = getattr(agent.client, "actual_usage_summary", None) or {}
+        usage = [model_usage for model_usage in usage_summary.values() if isinstance(model_usage, dict)]
+        return sum(model_usage.get("prompt_tokens", 0) for model_usage in usage), sum(model_usage.get("completion_tokens", 0) for model_usage in usage)
+
+    def parse_response(self, message: str) -> dict[str, Any]:
+        """
+        Parse the JSON object in an LLM response, such as the planner's plan, and return it as a dictionary.
+        A bare list is taken to be the plan. Returns an empty dictionary when the response holds no JSON.
+        """
+        parsed = extract_json(message)
+        if isinstance(parsed, list):
+            parsed = {"plan": parsed}
+        if not isinstance(parsed, dict):
+            logging.warning(f"LLM response was not properly formed JSON. LLM response: \"{message}\"")
+            return {}
+        return parsed
+
+    async def structured_chat(self, name: str, sender: ConversableAgent, recipient: ConversableAgent, message, validate: Callable[[dict[str, Any]], Any]) -> tuple[Any, str, Optional[str]]:
+        """
+        Run a one-turn chat whose reply should be JSON, and return validate(parsed reply) along with the reply itself.
+        JSON surrounded by other text is still picked out of the reply (the call is rescued). A reply that can't be parsed or validated
+        is retried, with the error, up to STRUCTURED_OUTPUT_RETRIES times, after which None is returned in place of the validated value,
+        along with the last error.
+        """
+        stats = self.structured_output_stats
+        span = _current_span.get()
+        prompt = message
+        for attempt in range(1 + max(0, self.valves.STRUCTURED_OUTPUT_RETRIES)):
+            if attempt:
+                stats["retried"] += 1
+                if span is not None:
+                    span.add("structured_output_retries")
+            reply = (await self.chat(name, sender, recipient, prompt, max_turns=1)).chat_history[-1]["content"]
+            stats["replies"] += 1
+            try:
+                result = validate(self.parse_response(reply))
+            except ValueError as e:
+                error = e
+                content = message["content"] if isinstance(message, dict) else message
+                prompt = f"{content}\n Your previous reply could not be used: {str(error)[:500]} \n Respond only with the json described, and no additional text."
+                continue
+            try:
+                json.loads(reply)
+            except ValueError:
+                stats["rescued"] += 1
+                if span is not None:
+                    span.add("structured_output_rescued")
+            return result, reply, None
+        stats["failed"] += 1
+        logging.warning(f"The {name} reply could not be parsed after {attempt + 1} attempts. LLM response: \"{reply}\". Error: {error}")
+        return None, reply, str(error)
+
+    def validate_plan(self, plan_dict: dict[str, Any]) -> list[dict[str, Any]]:
+        plan_graph = self.build_plan_graph(plan_dict)
+        if not plan_graph:
+            raise ValueError('The reply has no "plan" with any steps')
+        return plan_graph
+
+    async def get_agent_pool(self) -> AgentPool:
+        """
+        Return the agent pool for the current valves, acquired for the calling request, rebuilding it when any valve it was built from has changed.
+        The caller must release the pool when its request is complete.
+        """
+        valves = self.valves.model_dump(include=AGENT_POOL_VALVES)
+        retired_pool = None
+        # Nothing is awaited between the check and the swap, so overlapping requests can't both rebuild the pool
+        if self.agent_pool is None or self.agent_pool_valves != valves:
+            retired_pool = self.agent_pool
+            llm_config = {
+                "config_list": [{
+                    "model": self.valves.TASK_MODEL_ID,
+                    "base_url": self.valves.OPENAI_API_URL,
+                    "api_key": self.valves.OPENAI_API_KEY,
+                    "cache_seed": None,
+                    "price": [0.0, 0.0],
+                }],
+                "temperature": self.valves.MODEL_TEMPERATURE,
+            }
+            cache_store = SQLiteCacheStore(self.valves.SEARCH_CACHE_PATH) if self.valves.SEARCH_CACHE_PATH else None
+            caches = {
+                # Search terms are suggested by the task model, and results come from the Searx host, so keep them apart on disk
+                "search_term": TTLCache(f"search_term:{self.valves.TASK_MODEL_ID}", self.valves.SEARCH_CACHE_MAX_ENTRIES, self.valves.SEARCH_CACHE_TTL_SECONDS, cache_store, self.run_blocking),
+                "search_result": TTLCache(f"search_result:{self.valves.SEARX_HOST}", self.valves.SEARCH_CACHE_MAX_ENTRIES, self.valves.SEARCH_CACHE_TTL_SECONDS, cache_store, self.run_blocking),
+                # Access to knowledge bases can change at any time, so this one is kept short-lived and in memory only
+                "knowledge_bases": TTLCache("knowledge_bases", self.valves.SEARCH_CACHE_MAX_ENTRIES, self.valves.KNOWLEDGE_BASE_CACHE_SECONDS),
+                "plan": PlanCache(self.valves.PLAN_CACHE_MAX_ENTRIES, self.valves.PLAN_CACHE_TTL_SECONDS, self.valves.PLAN_CACHE_SIMILARITY),
+            }
+            searx_client = SearxClient(self.valves.SEARX_HOST, caches["search_result"])
+            utility_assistant = ConversableAgent(
+                name="Generic_Assistant",
+                llm_config=llm_config,
+                human_input_mode="NEVER"
+            )
+            self.offload_llm_replies(utility_assistant)
+            self.agent_pool = AgentPool(
+                create_team=partial(self.create_agent_team, llm_config, searx_client, caches),
+                utility_assistant=utility_assistant,
+                searx_client=searx_client,
+                openai_client=AsyncOpenAI(base_url=self.valves.OPENAI_API_URL, api_key=self.valves.OPENAI_API_KEY),
+                caches=caches,
+                max_idle_teams=self.valves.AGENT_POOL_SIZE,
+            )
+            self.agent_pool_valves = valves
+            if self.token_encoding_task is None:
+                # Token counts are estimated until the encoding is loaded, so no request ever waits on its download
+                self.token_encoding_task = asyncio.ensure_future(self.run_blocking(load_token_encoding))
+        agent_pool = self.agent_pool.acquire()
+        if retired_pool is not None:
+            # Requests still using the old pool keep its clients until they finish
+            await retired_pool.retire()
+        return agent_pool
+
+    def create_agent_team(self, llm_config: dict[str, Any], searx_client: SearxClient, caches: dict[str, TTLCache]) -> AgentTeam:
+        """
+        Build a team of agents from the given LLM config, with the tools registered.
+        """
+        team = AgentTeam(llm_config, self.valves.STRUCTURED_OUTPUT)
+        for agent in [team.generic_assistant, team.planner, team.assistant, team.reflection_assistant, team.critic, team.step_reviewer]:
+            self.offload_llm_replies(agent, coalesce=agent in (team.generic_assistant, team.critic))
+        self.register_tools(team, searx_client, caches)
+        return team
+
+    def register_tools(self, team: AgentTeam, searx_client: SearxClient, caches: dict[str, TTLCache]):
+        user_proxy = team.user_proxy
+        generic_assistant = team.generic_assistant
+        search_term_cache = caches["search_term"]
+        knowledge_base_cache = caches["knowledge_bases"]
+
+        @team.assistant.register_for_llm(name="web_search", description="Searches the web according to a given query")
         @user_proxy.register_for_execution(name="web_search")
-        def do_web_search(search_instruction: Annotated[str, "search instruction"]) -> str:
+        @self.traced_tool("web_search")
+        async def do_web_search(search_instruction: Annotated[str, "search instruction"]) -> str:
             """This function is used for searching the web for information that can only be found on the internet, not in the users personal notes.
             """
             if not search_instruction:
                 return "Please provide a search query."
 
-            # First, we convert the incoming query into a search term.
+            # First, we convert the incoming query into a search term. The suggestion depends on today's date, so it is part of the cache key.
             today = date.today().strftime("%Y-%m-%d")
+            query_count = self.valves.WEB_SEARCH_QUERIES
+            if query_count > 1:
+                cache_key = f"{today} {query_count} {normalize_query(search_instruction)}"
+                message = f"Given the user's message, suggest {query_count} different search terms that together best fulfill their query, each approaching it from a different angle. Make sure you are understanding the intent of their question. Respond with one search term per line and no additional text. Today's date is " + today + ". " + search_instruction
+            else:
+                cache_key = f"{today} {normalize_query(search_instruction)}"
+                message = "Given the user's message, suggest a search term to best fulfill their query. Make sure you are understanding the intent of their question. Today's date is " + today + ". " + search_instruction
+            summary = await search_term_cache.get(cache_key)
+            if summary is None:
+                chat_result = await self.chat("search_term", user_proxy, generic_assistant, message, max_turns=1)
+                summary = chat_result.chat_history[-1]['content']
+                await search_term_cache.set(cache_key, summary)
 
-            chat_result = user_proxy.initiate_chat(
-                recipient=generic_assistant,
-                message="Given the user's message, suggest a search term to best fulfill their query. Make sure you are understanding the intent of their question. Today's date is " + today + ". " + search_instruction,
-                max_turns=1,
-            )
-            summary = chat_result.chat_history[-1]['content']
-
-            search = SearxSearchWrapper(searx_host=searx_host)
-
-            response = search.run(query=summary)
+            async with self.trace_span("searx"):
+                if query_count > 1:
+                    # One search term per line, minus any list numbering, bullets or quotes the model added
+                    queries = [re.sub(r"^\s*(\d+[.)]|[-*\u2022])?\s*", "", line).strip().strip('"') for line in summary.splitlines()]
+                    queries = [query for query in queries if query][:query_count] or [summary]
+                    response = await searx_client.run_many(queries, rank_query=search_instruction, top_k=self.valves.WEB_SEARCH_TOP_K)
+                else:
+                    response = await searx_client.run(query=summary)
             return response
 
-        @assistant.register_for_llm(name="personal_knowledge_search", description="Searches personal documents according to a given query")
+        @team.assistant.register_for_llm(name="personal_knowledge_search", description="Searches personal documents according to a given query")
         @user_proxy.register_for_execution(name="personal_knowledge_search")
-        def do_knowledge_search(search_instruction: Annotated[str, "search instruction"]) -> str:
+        @self.traced_tool("personal_knowledge_search")
+        async def do_knowledge_search(search_instruction: Annotated[str, "search instruction"]) -> str:
             """Given an instruction on what knowledge you need to find, search the user's documents for information particular to them, their projects, and their domain.
             This is simple document search, it cannot perform any other complex tasks.
             This will not give you any results from the internet. Do not assume it can retrieve the latest news pertaining to any subject."""
             if not search_instruction:
                 return "Please provide a search query."
 
-            # First get all the user's knowledge bases associated with the model
-            knowledge_item_list = KnowledgeTable().get_knowledge_bases()
-            if len(knowledge_item_list) == 0:
+            # First get the knowledge bases the user can read. The list rarely changes, so it is cached for a short while
+            user_id = (_request_user.get() or {}).get("id")
+            collection_list = await knowledge_base_cache.get(user_id or "")
+            if collection_list is None:
+                knowledge_table = KnowledgeTable()
+                async with self.trace_span("knowledge_bases"):
+                    if user_id and hasattr(knowledge_table, "get_knowledge_bases_by_user_id"):
+                        knowledge_item_list = await self.run_blocking(knowledge_table.get_knowledge_bases_by_user_id, user_id, "read")
+                    else:
+                        knowledge_item_list = await self.run_blocking(knowledge_table.get_knowledge_bases)
+                collection_list = [item.id for item in knowledge_item_list]
+                await knowledge_base_cache.set(user_id or "", json.dumps(collection_list))
+            else:
+                collection_list = json.loads(collection_list)
+            if len(collection_list) == 0:
                 return "You don't have any knowledge bases."
-            collection_list = []
-            for item in knowledge_item_list:
-                collection_list.append(item.id)
 
-            collection_form = QueryCollectionsForm(
-                collection_names=collection_list,
-                query=search_instruction
+            # Query every knowledge base concurrently, then keep the best chunks across all of them
+            async def query_collection(collection_name):
+                collection_form = QueryCollectionsForm(
+                    collection_names=[collection_name],
+                    query=search_instruction,
+                    k=self.valves.KNOWLEDGE_PER_COLLECTION_K
+                )
+                async with self.trace_span("knowledge_query", collection=collection_name):
+                    return await self.run_blocking(query_collection_handler, collection_form)
+
+            responses = await asyncio.gather(*[query_collection(collection_name) for collection_name in collection_list], return_exceptions=True)
+            chunks = []
+            for collection_name, response in zip(collection_list, responses):
+                if isinstance(response, Exception):
+                    logging.error(f"Error searching knowledge base {collection_name}: {response}")
+                    continue
+                documents = response.get('documents') or []
+                metadatas = response.get('metadatas') or [[{}] * len(entries) for entries in documents]
+                distances = response.get('distances') or [[0.0] * len(entries) for entries in documents]
+                for entries, entry_metadatas, entry_distances in zip(documents, metadatas, distances):
+                    for document, metadata, distance in zip(entries, entry_metadatas, entry_distances):
+                        # Open WebUI normalizes distances so that a higher score means more relevant
+                        chunks.append({"content": document, "metadata": metadata, "score": distance, "collection": collection_name})
+
+            return select_knowledge_chunks(chunks, self.valves.KNOWLEDGE_TOP_K, self.valves.KNOWLEDGE_MAX_CHARS)
+
+    def create_step_context(self, team: AgentTeam, base: Optional[StepContext] = None) -> StepContext:
+        """
+        A new step context, or a copy of base, that is summarized by the given team's generic assistant.
+        """
+        async def summarize(summary, output, max_tokens):
+            # Most English text runs at about three words for every four tokens
+            prompt = CONTEXT_SUMMARY_PROMPT.format(summary=summary, output=output, max_words=max(1, max_tokens * 3 // 4))
+            chat_result = await self.chat("context_summary", team.user_proxy, team.generic_assistant, prompt, max_turns=1)
+            return chat_result.chat_history[-1]["content"]
+
+        if base is not None:
+            return base.copy(summarize)
+        return StepContext(self.valves.CONTEXT_TOKEN_BUDGET, summarize)
+
+    async def run_assistant(self, team: AgentTeam, instruction: str, step_context: StepContext) -> list[str]:
+        """
+        Have the research assistant carry out a single instruction, and return the assistant's replies.
+        """
+        prompt = instruction
+        if step_context:
+            prompt += f"\n Contextual Information: \n{step_context.render()}"
+        prompt_tokens = count_tokens(prompt)
+        logging.info(f"Step prompt is {prompt_tokens} tokens ({count_tokens(instruction) + step_context.uncompressed_tokens} without context summarization): {instruction}")
+        output = await self.chat("assistant", team.user_proxy, team.assistant, prompt, max_turns=3)
+
+        # Sort through the chat history and extract out replies from the assistant (We don't need the full results of the tool calls, just the assistant's summary)
+        previous_output = []
+        for chat_item in output.chat_history:
+            if chat_item["content"] and chat_item["name"] == "Research_Assistant":
+                previous_output.append(chat_item["content"])
+        return previous_output
+
+    async def stream_completion(self, agent_pool: AgentPool, prompt: str, request_started_at: Optional[float] = None,
+                                trace_parent: Optional[Span] = None, lane: Optional[int] = None) -> AsyncGenerator[str, None]:
+        """
+        Stream the generic assistant's reply to a prompt as it arrives from the OpenAI-compatible endpoint, logging the time to first token.
+        The call is traced under trace_parent, or the current span, and holds a slot of the LLM scheduler in the given lane, or the request's lane,
+        until the reply is complete. Streamed replies don't report usage, so their token counts are estimated.
+        """
+        call_started_at = time.perf_counter()
+        trace_parent = trace_parent or _current_span.get()
+        span = trace_parent.child("llm", agent=agent_pool.utility_assistant.name, streamed=True) if trace_parent is not None else None
+        completion = []
+        async with self.llm_scheduler.slot(lane if lane is not None else _llm_lane.get(), span):
+            stream = await agent_pool.openai_client.chat.completions.create(
+                model=self.valves.TASK_MODEL_ID,
+                messages=[
+                    {"role": "system", "content": agent_pool.utility_assistant.system_message},
+                    {"role": "user", "content": prompt},
+                ],
+                temperature=self.valves.MODEL_TEMPERATURE,
+                stream=True,
             )
+            first_token = True
+            async for chunk in stream:
+                content = chunk.choices[0].delta.content if chunk.choices else None
+                if not content:
+                    continue
+                if first_token:
+                    first_token = False
+                    now = time.perf_counter()
+                    waited = f"{now - call_started_at:.2f}s after the call was made"
+                    if request_started_at is not None:
+                        waited = f"{now - request_started_at:.2f}s after the request arrived, {waited}"
+                    logging.info(f"Time to first token: {waited}")
+                    if span is not None:
+                        span.attributes["time_to_first_token"] = round(now - call_started_at, 3)
+                completion.append(content)
+                yield content
+        if span is not None:
+            span.finish()
+            span.add("llm_calls")
+            span.add("prompt_tokens", count_tokens(agent_pool.utility_assistant.system_message) + count_tokens(prompt))
+            span.add("completion_tokens", count_tokens("".join(completion)))
+
+    async def execute_step(self, agent_pool: AgentPool, team: AgentTeam, instruction: str, step_context: StepContext, stream_output: bool = False) -> str:
+        """
+        Have the research assistant carry out a single instruction, and return its answer reformatted to directly address the instruction.
+        With stream_output, the answer is also streamed to the chat as it is generated.
+        """
+        previous_output = await self.run_assistant(team, instruction, step_context)
+
+        # It was found in testing that the output of the assistant will often contain the right information, but it will not be formatted in a manner that directly answers the instruction
+        # Therefore, the critic will take the assistant's output and reformat it to more directly answer the instruction that was given to the assistant
+        message = f"The instruction is: {instruction} Please directly answer the instruction given the following data: {previous_output}"
+        if stream_output:
+            chunks = []
+            async with self.trace_span("reformat", streamed=True):
+                async for chunk in self.stream_completion(agent_pool, message):
+                    chunks.append(chunk)
+                    await self.emit_event_safe(message=chunk, end="")
+                await self.emit_event_safe(message="")
+            return "".join(chunks)
+        critic_output = await self.chat("reformat", team.user_proxy, team.generic_assistant, message, max_turns=1)
+        return critic_output.chat_history[-1]["content"]
+
+    async def critique_step(self, team: AgentTeam, last_step: str, last_output: str) -> str:
+        """
+        Ask the critic whether a step was properly accomplished. The reply contains ##NO## and the reason when it was not.
+        """
+        message = CRITIC_PROMPT.format(last_step=last_step, last_output=last_output)
+        if not self.valves.STRUCTURED_OUTPUT:
+            return (await self.chat("critic", team.user_proxy, team.critic, message, max_turns=1)).chat_history[-1]["content"]
+        verdict, _, error = await self.structured_chat("critic", team.user_proxy, team.critic, message + CRITIC_JSON_FORMAT, CriticVerdict.model_validate)
+        if verdict is None:
+            # A verdict that can't be read must not let the step's output into the context, or its plan into the plan cache
+            return f"##NO## The critic's verdict could not be parsed: {error[:500]}"
+        return "##YES##" if verdict.accomplished else f"##NO## {verdict.reason}"
+
+    def following_plan_step(self, plan_steps: dict[str, list], steps_taken: list, instruction: str) -> str:
+        """
+        The first step of the plan, other than instruction, that has not been taken yet, or ##TERMINATE## when there is none.
+        """
+        remaining_steps = [step for step in plan_steps["plan"] if step != instruction and step not in steps_taken]
+        return remaining_steps[0] if remaining_steps else "##TERMINATE##"
+
+    async def next_step(self, team: AgentTeam, message: dict[str, Any], plan_steps: dict[str, list], steps_taken: list, last_step: str) -> str:
+        """
+        Ask the reflection assistant for the next step to take. The reply is ##TERMINATE## when there are no more steps.
+        """
+        if not self.valves.STRUCTURED_OUTPUT:
+            return (await self.chat("reflection", team.user_proxy, team.reflection_assistant, str(message), max_turns=1)).chat_history[-1]["content"]
+        next_step, _, error = await self.structured_chat("reflection", team.user_proxy, team.reflection_assistant, str(message) + REFLECTION_JSON_FORMAT, NextStep.model_validate)
+        if next_step is None:
+            # A half-formed reply must not be run as an instruction, so move on to the next step of the plan in order
+            following_step = self.following_plan_step(plan_steps, steps_taken, last_step)
+            logging.warning(f"Falling back to the next step of the plan, {following_step}, since the reflection reply could not be parsed: {error}")
+            return following_step
+        return "##TERMINATE##" if next_step.terminate or not next_step.next_step.strip() else next_step.next_step
+
+    async def review_step(self, team: AgentTeam, goal, plan_steps: dict[str, list], steps_taken: list, instruction: str, previous_output: list[str]) -> StepReview:
+        """
+        Reformat a step's output, judge whether it was accomplished and decide the next step, all in one structured LLM call.
+        """
+        message = {
+            "Goal": goal,
+            "Plan": str(plan_steps),
+            "Steps Taken": str(steps_taken),
+            "Instruction": instruction,
+            "Assistant Output": str(previous_output),
+        }
+        review, reply, _ = await self.structured_chat("step_review", team.user_proxy, team.step_reviewer, str(message), StepReview.model_validate)
+        if review is None:
+            # Keep whatever fields of the review could be picked out of the reply. The step only counts as accomplished when the reply
+            # says so and has an answer, since a half-formed reply must not end up in the context as the step's answer
+            fields = self.parse_response(reply)
+            answer, next_step = fields.get("answer"), fields.get("next_step")
+            accomplished = fields.get("accomplished") is True and isinstance(answer, str) and bool(answer.strip())
+            if not isinstance(next_step, str) or not next_step.strip():
+                # Move on to the next step of the plan in order
+                next_step = self.following_plan_step(plan_steps, steps_taken, instruction)
+            reason = "" if accomplished else str(fields.get("reason") or "The review of the step could not be parsed")
+            return StepReview(answer=answer if accomplished else "", accomplished=accomplished, reason=reason, next_step=next_step)
+        return review
+
+    def build_plan_graph(self, plan_dict: dict[str, Any]) -> list[dict[str, Any]]:
+        """
+        Normalize the planner's plan into a list of steps of the form {"id", "instruction", "depends_on"}, numbered from 1 in plan order.
+        Steps given as plain strings depend on the step before them. Dependencies may only point at earlier steps, which keeps the graph acyclic.
+        """
+        plan = plan_dict.get("plan", [])
+        if isinstance(plan, str):
+            plan = [plan]
+        if not isinstance(plan, list):
+            plan = []
 
-            response = query_collection_handler(collection_form)
-            messages = ""
-            for entries in response['documents']:
-                for line in entries:
-                    messages += line
+        # Map the ids the planner used onto plan positions
+        id_map = {}
+        for position, item in enumerate(plan, start=1):
+            if isinstance(item, dict):
+                id_map[str(item.get("id", position))] = position
 
-            return messages
+        plan_graph = []
+        for position, item in enumerate(plan, start=1):
+            if isinstance(item, dict):
+                instruction = str(item.get("instruction", item.get("step", ""))).strip()
+                depends_on = item.get("depends_on", [])
+                if not isinstance(depends_on, list):
+                    depends_on = [depends_on]
+                depends_on = sorted({id_map[str(dep)] for dep in depends_on if id_map.get(str(dep), position) < position})
+            else:
+                instruction = str(item).strip()
+                depends_on = [position - 1] if position > 1 else []
+            if instruction:
+                plan_graph.append({"id": position, "instruction": instruction, "depends_on": depends_on})
 
+        # Drop dependencies on any steps that were discarded for being empty
+        step_ids = {step["id"] for step in plan_graph}
+        for step in plan_graph:
+            step["depends_on"] = [dep for dep in step["depends_on"] if dep in step_ids]
+        return plan_graph
+
+    def plan_width(self, plan_graph: list[dict[str, Any]]) -> int:
+        """
+        The largest number of steps in the plan that could run at the same time.
+        """
+        levels = {}
+        for step in plan_graph:
+            levels[step["id"]] = 1 + max([levels[dep] for dep in step["depends_on"]], default=0)
+        level_sizes = {}
+        for level in levels.values():
+            level_sizes[level] = level_sizes.get(level, 0) + 1
+        return max(level_sizes.values(), default=0)
+
+    async def execute_plan_graph(self, agent_pool: AgentPool, team: AgentTeam, goal, plan_graph: list[dict[str, Any]]) -> tuple[StepContext, list]:
+        """
+        Execute the plan as a dependency graph. Steps whose dependencies have completed run concurrently, up to the MAX_PARALLEL_STEPS valve.
+        Each step gets a critic review (or a step review in the fast workflow) and one retry if it was not accomplished.
+        Returns the context of all the successful steps' outputs, summarized with the given team, and the successful steps in plan order.
+        """
+        semaphore = asyncio.Semaphore(max(1, self.valves.MAX_PARALLEL_STEPS))
+        plan_steps = {"plan": [step["instruction"] for step in plan_graph]}
+        steps_by_id = {step["id"]: step for step in plan_graph}
+        results = {}  # Step id -> output, or None if the step could not be accomplished
+        # Step id -> (the step's context with its own output added, ids of the steps whose outputs it holds), for successful steps.
+        # Later steps and the final answer build on these instead of adding, and summarizing, every earlier output again
+        completed_contexts = {}
+
+        def merged_context(team, step_ids):
+            # Copy the completed context that holds the most of the given steps' outputs. Returns it and the ids of the outputs it holds
+            base, base_ids = None, set()
+            for step_id in step_ids:
+                context, context_ids = completed_contexts[step_id]
+                if context_ids <= step_ids and len(context_ids) > len(base_ids):
+                    base, base_ids = context, context_ids
+            return self.create_step_context(team, base), base_ids
+
+        async def add_outputs(context, step_ids, included_ids):
+            for step_id in sorted(step_ids - included_ids):
+                await context.add(results[step_id])
+
+        async def run_step(step):
+            # The context for a step is the output of every step it (transitively) depends on
+            ancestors = set()
+            frontier = list(step["depends_on"])
+            while frontier:
+                step_id = frontier.pop()
+                if step_id not in ancestors:
+                    ancestors.add(step_id)
+                    frontier.extend(steps_by_id[step_id]["depends_on"])
+
+            async with semaphore, agent_pool.team() as team, self.trace_span("step", instruction=step["instruction"]) as span:
+                context_ids = {step_id for step_id in ancestors if results.get(step_id)}
+                step_context, included_ids = merged_context(team, context_ids)
+                await add_outputs(step_context, context_ids, included_ids)
+                output = await attempt_step(team, step, step_context, ancestors, span)
+                if output:
+                    # The step's output goes into its context while the step still has its team to summarize with
+                    await step_context.add(output)
+                    completed_contexts[step["id"]] = (step_context, context_ids | {step["id"]})
+                return output
+
+        async def attempt_step(team, step, step_context, ancestors, span):
+            instruction = step["instruction"]
+            for attempt in range(2):
+                if attempt and span is not None:
+                    span.add("retries")
+                await self.emit_event_safe(message="Executing step: " + instruction)
+                if self.valves.FAST_WORKFLOW:
+                    previous_output = await self.run_assistant(team, instruction, step_context)
+                    steps_taken = [steps_by_id[step_id]["instruction"] for step_id in sorted(ancestors) if results.get(step_id)]
+                    review = await self.review_step(team, goal, plan_steps, steps_taken, instruction, previous_output)
+                    if review.accomplished:
+                        return review.answer
+                    was_job_accomplished = review.reason
+                else:
+                    output = await self.execute_step(agent_pool, team, instruction, step_context)
+                    was_job_accomplished = await self.critique_step(team, instruction, output)
+                    if "##NO##" not in was_job_accomplished:
+                        return output
+                instruction = f"{step['instruction']}\n A previous attempt at this step was not accomplished satisfactorily due to the following reason: \n {was_job_accomplished}"
+            if span is not None:
+                span.attributes["accomplished"] = False
+            return None
+
+        pending = list(plan_graph)
+        running = {}
+        try:
+            while pending or running:
+                for step in [step for step in pending if all(dep in results for dep in step["depends_on"])]:
+                    pending.remove(step)
+                    running[asyncio.create_task(run_step(step))] = step["id"]
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    results[running.pop(task)] = task.result()
+        finally:
+            # When a step fails (or the request is cancelled), stop the steps still running rather than leave them using the LLM and agent teams
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+
+        # Outputs not already held are added in plan order, so the final answer does not depend on which step finished first
+        succeeded_ids = {step["id"] for step in plan_graph if results[step["id"]]}
+        step_context, included_ids = merged_context(team, succeeded_ids)
+        await add_outputs(step_context, succeeded_ids, included_ids)
+        steps_taken = [step["instruction"] for step in plan_graph if step["id"] in succeeded_ids]
+        return step_context, steps_taken
+
+    async def pipe(
+        self,
+        body,
+        __user__: Optional[dict] = None,
+        __event_emitter__: Callable[[dict], Awaitable[None]] = None,
+    ) -> str | AsyncGenerator[str, None]:
+
+        request_started_at = time.perf_counter()
+        _request_event_emitter.set(__event_emitter__)
+        _request_user.set(__user__)
+        _current_span.set(None)
+        _llm_lane.set(LANE_PLAN_STEPS)
+        self.llm_scheduler.set_limit(self.valves.MAX_CONCURRENT_LLM_CALLS)
+        agent_pool = await self.get_agent_pool()
+        # Open WebUI can replace the valves while the request runs, so decide up front how the answer is returned
+        stream_final_answer = self.valves.STREAM_FINAL_ANSWER
+        streaming = False
+        try:
+            ##################
+            # Check if this request is utility call from OpenWebUI
+            ##################
+            if self.is_open_webui_request(body["messages"]):
+                print("Is open webui request")
+                _llm_lane.set(LANE_UTILITY)
+                reply = await agent_pool.utility_assistant.a_generate_reply(messages=[body['messages'][-1]])
+                return reply
+
+            trace = Span("request", attributes={"model": self.valves.TASK_MODEL_ID})
+            _current_span.set(trace)
+            async with agent_pool.team() as team:
+                final_prompt = await self.run_agentic_workflow(agent_pool, team, body)
+                _llm_lane.set(LANE_FINAL_ANSWER)
+                if not stream_final_answer:
+                    final_output = (await self.chat("final_answer", team.user_proxy, team.generic_assistant, final_prompt, max_turns=1)).chat_history[-1]["content"]
+            logging.info(f"Search cache stats: {agent_pool.cache_stats()}")
+            logging.info(f"Structured output stats: {self.structured_output_stats}")
+            logging.info(f"LLM scheduler stats: {self.llm_scheduler.stats()}")
+
+            if stream_final_answer:
+                # Open WebUI streams an async generator to the chat as it produces tokens. The generator releases the pool when it is done
+                streaming = True
+                return self.stream_final_answer(agent_pool, final_prompt, request_started_at, trace)
+            return final_output + await self.finish_trace(trace)
+        finally:
+            if not streaming:
+                await agent_pool.release()
+
+    async def stream_final_answer(self, agent_pool: AgentPool, final_prompt: str, request_started_at: float, trace: Span) -> AsyncGenerator[str, None]:
+        """
+        Stream the final answer, then end the request's trace once the answer is complete.
+        """
+        # The generator is consumed outside of the request's context, so its span is attached to the trace explicitly
+        span = trace.child("final_answer", streamed=True)
+        try:
+            async for chunk in self.stream_completion(agent_pool, final_prompt, request_started_at, trace_parent=span, lane=LANE_FINAL_ANSWER):
+                yield chunk
+            span.finish()
+            timing_summary = await self.finish_trace(trace)
+            if timing_summary:
+                yield timing_summary
+        finally:
+            await agent_pool.release()
+
+    async def is_direct_query(self, team: AgentTeam, query: str) -> bool:
+        """
+        Decide, as set by the QUERY_ROUTER valve, whether a query is simple enough to answer with a single assistant turn rather than a plan.
+        """
+        router = self.valves.QUERY_ROUTER.strip().lower()
+        if router == "heuristic":
+            return is_simple_query(query)
+        if router == "llm":
+            # Long queries are never simple, so don't spend a call on them
+            if len(query.split()) > 50:
+                return False
+            reply = (await self.chat("route", team.user_proxy, team.generic_assistant, ROUTER_PROMPT.format(query=query), max_turns=1)).chat_history[-1]["content"]
+            return "##SIMPLE##" in reply
+        return False
+
+    async def run_agentic_workflow(self, agent_pool: AgentPool, team: AgentTeam, body) -> str:
+        """
+        Plan and execute the steps needed to answer the user's query, and return the prompt for the final answer.
+        """
         #########################
         # Begin Agentic Workflow
         #########################
+        max_plan_steps = self.valves.MAX_PLAN_STEPS
+        user_proxy = team.user_proxy
+        trace = _current_span.get()
+        step_context = self.create_step_context(team)  # This variable tracks the output of previous successful steps as context for executing the next step
 
-        # Make a plan
-        await self.emit_event_safe(message="Creating a plan...")
-        raw_plan = user_proxy.initiate_chat(message=body['messages'][-1], max_turns=1, recipient=planner).chat_history[-1]["content"]
-        plan_dict = self.parse_response(raw_plan)
+        # A query that a single search can answer goes straight to the assistant
+        query = str(body['messages'][-1]['content'])
+        if await self.is_direct_query(team, query):
+            await self.emit_event_safe(message="Executing step: " + query)
+            async with self.trace_span("step", instruction=query) as span:
+                previous_output = await self.run_assistant(team, query, step_context)
+            answers = [output.replace("##SUMMARY##", "").strip() for output in previous_output]
+            if answers and not any("##TERMINATE##" in answer for answer in answers):
+                await step_context.add("\n".join(answers))
+                return await self.final_answer_prompt(body, step_context)
+            # The assistant could not answer on its own, so fall back to making a plan
+            if span is not None:
+                span.attributes["accomplished"] = False
+
+        # Make a plan, unless the user asked something similar before and that plan worked
+        plan_cache = agent_pool.caches["plan"]
+        user_id = (_request_user.get() or {}).get("id") or ""
+        plan_graph = plan_cache.get(user_id, query)
+        cached_plan = plan_graph is not None
+        if cached_plan:
+            await self.emit_event_safe(message="Reusing the plan of a similar earlier request...")
+            if trace is not None:
+                trace.attributes["plan_cache_hit"] = True
+        else:
+            await self.emit_event_safe(message="Creating a plan...")
+            plan_graph, _, _ = await self.structured_chat("plan", user_proxy, team.planner, body['messages'][-1], self.validate_plan)
+            plan_graph = plan_graph or []
+        # Only a plan that the planner's response was parsed into is worth caching, not the fallback below
+        can_cache_plan = bool(plan_graph) and not cached_plan
+        if not plan_graph:
+            # Without a usable plan, treat the user's query as a single step
+            plan_graph = [{"id": 1, "instruction": str(body['messages'][-1]['content']), "depends_on": []}]
+        plan_steps = {"plan": [step["instruction"] for step in plan_graph]}
 
         # Start executing plan
-        answer_output = []  # This variable tracks the output of previous successful steps as context for executing the next step
         steps_taken = []  # A list of steps already executed
+        plan_succeeded = True  # Whether every step executed was accomplished
         last_output = ""  # Output of the single previous step gets put here
 
-        for _ in range(max_plan_steps):
-            if last_output == "":
-                # This is the first step of the plan since there's no previous output
-                instruction = plan_dict['plan'][0]
-            else:
-                # Previous steps in the plan have already been executed.
-                await self.emit_event_safe(message="Planning the next step...")
-                reflection_message = last_step
-                # Ask the critic if the previous step was properly accomplished
-                was_job_accomplished = user_proxy.initiate_chat(recipient=generic_assistant, max_turns=1,
-                                                                message=CRITIC_PROMPT.format(last_step=last_step, last_output=last_output)).chat_history[-1]["content"]
-                # If it was not accomplished, make sure an explanation is provided for the reflection assistant
-                if "##NO##" in was_job_accomplished:
-                    reflection_message = f"The previous step was {last_step} but it was not accomplished satisfactorily due to the following reason: \n {was_job_accomplished}."
-
-                # Then, ask the reflection agent for the next step
-                message = {
-                    "Goal": body['messages'][-1],
-                    "Plan": str(plan_dict),
-                    "Last Step": reflection_message,
-                    "Last Step Output": str(last_output),
-                    "Steps Taken": str(steps_taken),
-                }
-                instruction = user_proxy.initiate_chat(recipient=reflection_assistant, max_turns=1, message=str(message)).chat_history[-1]["content"]
-
-                # Only append the previous step and its output to the record if it accomplished its task successfully.
-                # It was found that storing information about unsuccesful steps causes more confusion than help to the agents
-                if not "##NO##" in was_job_accomplished:
-                    answer_output.append(last_output)
-                    steps_taken.append(last_step)
-
-                if "##TERMINATE##" in instruction:
-                    # A termination message means there are no more steps to take. Exit the loop.
+        if self.valves.MAX_PARALLEL_STEPS > 1 and self.plan_width(plan_graph) > 1:
+            # Independent steps don't need to wait on each other, so execute the plan as a dependency graph
+            step_context, steps_taken = await self.execute_plan_graph(agent_pool, team, body['messages'][-1], plan_graph[:max_plan_steps])
+            plan_succeeded = len(steps_taken) == len(plan_graph[:max_plan_steps])
+        elif self.valves.FAST_WORKFLOW:
+            # Each step is one assistant run followed by one structured review, which both answers the step and picks the next one
+            instruction = plan_graph[0]["instruction"]
+            for _ in range(max_plan_steps):
+                async with self.trace_span("step", instruction=instruction) as span:
+                    await self.emit_event_safe(message="Executing step: " + instruction)
+                    previous_output = await self.run_assistant(team, instruction, step_context)
+
+                    await self.emit_event_safe(message="Planning the next step...")
+                    review = await self.review_step(team, body['messages'][-1], plan_steps, steps_taken, instruction, previous_output)
+                # As in the standard workflow, only successful steps are recorded
+                if review.accomplished:
+                    await step_context.add(review.answer)
+                    steps_taken.append(instruction)
+                else:
+                    plan_succeeded = False
+                    if span is not None:
+                        span.attributes["accomplished"] = False
+                        trace.add("retries")
+
+                if "##TERMINATE##" in review.next_step or (review.accomplished and instruction.strip() == plan_steps["plan"][-1].strip()):
                     break
+                instruction = review.next_step
+        else:
+            for _ in range(max_plan_steps):
+                if last_output == "":
+                    # This is the first step of the plan since there's no previous output
+                    instruction = plan_graph[0]["instruction"]
+                else:
+                    # Previous steps in the plan have already been executed.
+                    await self.emit_event_safe(message="Planning the next step...")
+                    async with self.trace_span("next_step"):
+                        reflection_message = last_step
+                        # Ask the critic if the previous step was properly accomplished
+                        was_job_accomplished = await self.critique_step(team, last_step, last_output)
+                        # If it was not accomplished, make sure an explanation is provided for the reflection assistant
+                        if "##NO##" in was_job_accomplished:
+                            reflection_message = f"The previous step was {last_step} but it was not accomplished satisfactorily due to the following reason: \n {was_job_accomplished}."
+                            plan_succeeded = False
+                            if last_step_span is not None:
+                                last_step_span.attributes["accomplished"] = False
+                                trace.add("retries")
 
-            # Now that we have determined the next step to take, execute it
-            await self.emit_event_safe(message="Executing step: " + instruction)
-            prompt = instruction
-            if answer_output:
-                prompt += f"\n Contextual Information: \n{answer_output}"
-            output = user_proxy.initiate_chat(recipient=assistant, max_turns=3, message=prompt)
-
-            # Sort through the chat history and extract out replies from the assistant (We don't need the full results of the tool calls, just the assistant's summary)
-            previous_output = []
-            for chat_item in output.chat_history:
-                if chat_item["content"] and chat_item["name"] == "Research_Assistant":
-                    previous_output.append(chat_item["content"])
-            
-            # It was found in testing that the output of the assistant will often contain the right information, but it will not be formatted in a manner that directly answers the instruction
-            # Therefore, the critic will take the assistant's output and reformat it to more directly answer the instruction that was given to the assistant
-            critic_output = user_proxy.initiate_chat(recipient=generic_assistant, max_turns=1, message=f"The instruction is: {instruction} Please directly answer the instruction given the following data: {previous_output}")
-
-            # The previous instruction and its output will be recorded for the next iteration to inspect before determining the next step of the plan
-            last_output = critic_output.chat_history[-1]["content"]
-            last_step = instruction
-        
-        await self.emit_event_safe(message="Summing up findings...")
-        # Now that we've gathered all the information we need, we will summarize it to directly answer the original prompt
-        final_prompt = f"Answer the user's query: {body['messages'][-1]}. Using the following contextual informaiton only: {answer_output}"
-        final_output = user_proxy.initiate_chat(message=final_prompt, max_turns=1, recipient=generic_assistant).chat_history[-1]["content"]
+                        if "##NO##" not in was_job_accomplished and last_step.strip() == plan_steps["plan"][-1].strip():
+                            # The last step of the plan was accomplished, so there is no next step to ask the reflection agent for
+                            instruction = "##TERMINATE##"
+                        else:
+                            # Then, ask the reflection agent for the next step
+                            message = {
+                                "Goal": body['messages'][-1],
+                                "Plan": str(plan_steps),
+                                "Last Step": reflection_message,
+                                "Last Step Output": str(last_output),
+                                "Steps Taken": str(steps_taken),
+                            }
+                            instruction = await self.next_step(team, message, plan_steps, steps_taken, last_step)
+
+                    # Only append the previous step and its output to the record if it accomplished its task successfully.
+                    # It was found that storing information about unsuccesful steps causes more confusion than help to the agents
+                    if not "##NO##" in was_job_accomplished:
+                        await step_context.add(last_output)
+                        steps_taken.append(last_step)
 
-        return(final_output)
+                    if "##TERMINATE##" in instruction:
+                        # A termination message means there are no more steps to take. Exit the loop.
+                        break
+
+                # Now that we have determined the next step to take, execute it
+                await self.emit_event_safe(message="Executing step: " + instruction)
+
+                # The previous instruction and its output will be recorded for the next iteration to inspect before determining the next step of the plan
+                async with self.trace_span("step", instruction=instruction) as last_step_span:
+                    last_output = await self.execute_step(agent_pool, team, instruction, step_context, stream_output=self.valves.STREAM_STEP_OUTPUTS)
+                last_step = instruction
+
+        # Plans that ran into failed steps are not reused
+        if can_cache_plan and plan_succeeded and steps_taken:
+            plan_cache.set(user_id, query, plan_graph)
+        return await self.final_answer_prompt(body, step_context)
+
+    async def final_answer_prompt(self, body, step_context: StepContext) -> str:
+        await self.emit_event_safe(message="Summing up findings...")
+        # Now that we've gathered all the information we need, the final prompt will summarize it to directly answer the original prompt
+        return f"Answer the user's query: {body['messages'][-1]}. Using the following contextual informaiton only: {step_context.render()}"
@@ -0,0 +1,14 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks"))
+
+# The pipe imports Open WebUI's retrieval and knowledge modules, which are only available inside Open WebUI.
+# Outside of it, use the stand-ins the benchmarks run against.
+try:
+    import open_webui.routers.retrieval  # noqa: F401
+    import open_webui.models.knowledge  # noqa: F401
+except ImportError:
+    from mock_services import install_open_webui_stubs
+    install_open_webui_stubs()
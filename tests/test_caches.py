@@ -0,0 +1,148 @@
+import asyncio
+
+import pytest
+
+import granite_autogen_rag
+from granite_autogen_rag import PlanCache, SQLiteCacheStore, TTLCache, normalize_query
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(granite_autogen_rag.time, "time", clock.time)
+    return clock
+
+
+def plan(*instructions):
+    return [{"id": index, "instruction": instruction, "depends_on": []} for index, instruction in enumerate(instructions, start=1)]
+
+
+####################
+# normalize_query
+####################
+def test_normalize_query_folds_case_and_spacing():
+    assert normalize_query("  Latest   Granite\tNews ") == "latest granite news"
+
+
+@pytest.mark.parametrize("query, other", [
+    ("C++ 23 release news", "C 23 release news"),
+    ("C# news", "C news"),
+    ("rust -game", "rust game"),
+    ('"rust game"', "rust game"),
+])
+def test_normalize_query_keeps_punctuation(query, other):
+    assert normalize_query(query) != normalize_query(other)
+
+
+####################
+# TTLCache
+####################
+def test_ttl_cache_entries_expire(clock):
+    async def run():
+        cache = TTLCache("test", max_entries=10, ttl_seconds=60)
+        await cache.set("key", "value")
+        clock.now += 59
+        fresh = await cache.get("key")
+        clock.now += 2
+        return cache, fresh, await cache.get("key")
+
+    cache, fresh, expired = asyncio.run(run())
+    assert fresh == "value"
+    assert expired is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    async def run():
+        cache = TTLCache("test", max_entries=2, ttl_seconds=60)
+        await cache.set("a", "1")
+        await cache.set("b", "2")
+        await cache.get("a")
+        await cache.set("c", "3")
+        return [await cache.get(key) for key in ["a", "b", "c"]]
+
+    assert asyncio.run(run()) == ["1", None, "3"]
+
+
+def test_ttl_cache_disabled_without_ttl():
+    async def run():
+        cache = TTLCache("test", max_entries=10, ttl_seconds=0)
+        await cache.set("key", "value")
+        return await cache.get("key")
+
+    assert asyncio.run(run()) is None
+
+
+def test_ttl_cache_shares_entries_through_the_store(tmp_path, clock):
+    store = SQLiteCacheStore(str(tmp_path / "cache.db"))
+
+    async def run():
+        await TTLCache("search", max_entries=10, ttl_seconds=60, store=store).set("key", "value")
+        other_worker = TTLCache("search", max_entries=10, ttl_seconds=60, store=store)
+        other_namespace = TTLCache("other", max_entries=10, ttl_seconds=60, store=store)
+        shared = await other_worker.get("key")
+        separate = await other_namespace.get("key")
+        clock.now += 61
+        expired = await TTLCache("search", max_entries=10, ttl_seconds=60, store=store).get("key")
+        return shared, separate, expired
+
+    assert asyncio.run(run()) == ("value", None, None)
+
+
+def test_store_keeps_each_namespace_within_its_size_limit(tmp_path, clock):
+    store = SQLiteCacheStore(str(tmp_path / "cache.db"))
+    for index in range(5):
+        clock.now += 1
+        store.set("search", f"key {index}", "value", clock.now + 60, max_entries=3)
+    assert [store.get("search", f"key {index}") is not None for index in range(5)] == [False, False, True, True, True]
+
+
+####################
+# PlanCache
+####################
+def test_plan_cache_exact_and_similar_matches():
+    cache = PlanCache(max_entries=10, ttl_seconds=60, similarity_threshold=0.6)
+    cache.set("user", "Find the latest news about Kubernetes", plan("Search the internet for the latest news about Kubernetes"))
+    assert cache.get("user", "find the  latest news about Kubernetes") is not None
+    assert cache.get("user", "Find latest news about Kubernetes please") is not None
+    assert cache.get("other user", "Find the latest news about Kubernetes") is None
+
+
+def test_plan_cache_rejects_plans_that_mention_a_differing_word():
+    cache = PlanCache(max_entries=10, ttl_seconds=60, similarity_threshold=0.5)
+    cache.set("user", "Compare C and Rust adoption", plan("Search the adoption of C", "Search the adoption of Rust"))
+    cache.set("user", "Find the latest news about Kubernetes and Ray", plan("Search news about Kubernetes", "Search news about Ray"))
+    assert cache.get("user", "Compare C++ and Rust adoption") is None
+    assert cache.get("user", "Find the latest news about Kubernetes and vLLM") is None
+
+
+def test_plan_cache_returns_a_copy():
+    cache = PlanCache(max_entries=10, ttl_seconds=60, similarity_threshold=0.9)
+    cache.set("user", "query", plan("Search A"))
+    cache.get("user", "query")[0]["instruction"] = "changed"
+    assert cache.get("user", "query")[0]["instruction"] == "Search A"
+
+
+def test_plan_cache_entries_expire(clock):
+    cache = PlanCache(max_entries=10, ttl_seconds=60, similarity_threshold=0.9)
+    cache.set("user", "query", plan("Search A"))
+    clock.now += 61
+    assert cache.get("user", "query") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_plan_cache_evicts_least_recently_used():
+    cache = PlanCache(max_entries=2, ttl_seconds=60, similarity_threshold=1.0)
+    cache.set("user", "alpha query", plan("Search alpha"))
+    cache.set("user", "beta query", plan("Search beta"))
+    cache.get("user", "alpha query")
+    cache.set("user", "gamma query", plan("Search gamma"))
+    assert [cache.get("user", f"{name} query") is not None for name in ["alpha", "beta", "gamma"]] == [True, False, True]
@@ -0,0 +1,44 @@
+from granite_autogen_rag import select_knowledge_chunks
+
+
+def chunk(content, score, name=None, collection="notes"):
+    return {"content": content, "score": score, "metadata": {"name": name} if name else None, "collection": collection}
+
+
+def test_selects_top_chunks_by_score_with_their_source():
+    chunks = [
+        chunk("The team uses Ray for preprocessing.", 0.2, "pipeline.md"),
+        chunk("The platform is moving to Kubernetes.", 0.9, "meeting-notes.md"),
+        chunk("Granite models are served with vLLM.", 0.5, collection="roadmap"),
+    ]
+    assert select_knowledge_chunks(chunks, top_k=2, max_chars=1000) == (
+        "[Source: meeting-notes.md] The platform is moving to Kubernetes.\n\n"
+        "[Source: roadmap] Granite models are served with vLLM."
+    )
+
+
+def test_skips_near_duplicate_chunks():
+    chunks = [
+        chunk("The platform is moving to Kubernetes this quarter.", 0.9, collection="notes"),
+        chunk("The platform is moving to Kubernetes this quarter!", 0.8, collection="archive"),
+        chunk("Granite models are served with vLLM.", 0.5),
+    ]
+    result = select_knowledge_chunks(chunks, top_k=3, max_chars=1000)
+    assert result.count("Kubernetes") == 1
+    assert "vLLM" in result
+
+
+def test_stays_within_max_chars():
+    chunks = [chunk("a" * 60, 0.9), chunk("b " * 100, 0.8), chunk("c" * 20, 0.7)]
+    result = select_knowledge_chunks(chunks, top_k=3, max_chars=120)
+    assert len(result) <= 120 + len("\n\n")
+    assert "b b" not in result
+    assert "c" * 20 in result
+
+
+def test_truncates_a_first_chunk_over_max_chars():
+    assert select_knowledge_chunks([chunk("word " * 100, 0.9)], top_k=3, max_chars=50) == ("[Source: notes] " + "word " * 100)[:50]
+
+
+def test_no_chunks():
+    assert select_knowledge_chunks([], top_k=3, max_chars=100) == ""
@@ -0,0 +1,137 @@
+import pytest
+
+from granite_autogen_rag import Pipe, extract_json
+
+
+@pytest.fixture
+def pipe():
+    return Pipe()
+
+
+####################
+# extract_json
+####################
+def test_extract_json_object():
+    assert extract_json('{"plan": ["a", "b"]}') == {"plan": ["a", "b"]}
+
+
+def test_extract_json_ignores_surrounding_text_and_code_fences():
+    reply = 'Here is the plan:\n```json\n{"plan": [{"id": 1, "instruction": "Search A", "depends_on": []}]}\n```\nLet me know.'
+    assert extract_json(reply) == {"plan": [{"id": 1, "instruction": "Search A", "depends_on": []}]}
+
+
+def test_extract_json_bare_list_of_objects_is_returned_whole():
+    reply = '[{"id": 1, "instruction": "Search A", "depends_on": []}, {"id": 2, "instruction": "Search B", "depends_on": [1]}]'
+    assert extract_json(reply) == [
+        {"id": 1, "instruction": "Search A", "depends_on": []},
+        {"id": 2, "instruction": "Search B", "depends_on": [1]},
+    ]
+
+
+def test_extract_json_python_literal():
+    assert extract_json("{'accomplished': True, 'reason': ''}") == {"accomplished": True, "reason": ""}
+
+
+def test_extract_json_skips_sets():
+    assert extract_json('Using {1, 2} then {"terminate": false, "next_step": "Search B"}') == {"terminate": False, "next_step": "Search B"}
+
+
+def test_extract_json_skips_unparseable_candidates():
+    assert extract_json('{not json} and then {"accomplished": false, "reason": "no results"}') == {"accomplished": False, "reason": "no results"}
+
+
+def test_extract_json_brackets_inside_strings():
+    assert extract_json("{'answer': 'a } and a ] inside', 'accomplished': True}") == {"answer": "a } and a ] inside", "accomplished": True}
+
+
+@pytest.mark.parametrize("reply", ["", "##TERMINATE##", "no json here", '{"answer": "Half'])
+def test_extract_json_nothing_parses(reply):
+    assert extract_json(reply) is None
+
+
+####################
+# parse_response
+####################
+def test_parse_response_object(pipe):
+    assert pipe.parse_response('{"plan": ["Search A"]}') == {"plan": ["Search A"]}
+
+
+def test_parse_response_bare_list_is_the_plan(pipe):
+    reply = '[{"id": 1, "instruction": "Search A", "depends_on": []}, {"id": 2, "instruction": "Search B", "depends_on": []}]'
+    assert pipe.parse_response(reply) == {"plan": [
+        {"id": 1, "instruction": "Search A", "depends_on": []},
+        {"id": 2, "instruction": "Search B", "depends_on": []},
+    ]}
+
+
+def test_parse_response_without_json(pipe):
+    assert pipe.parse_response("I could not make a plan.") == {}
+
+
+def test_validate_plan_accepts_bare_list(pipe):
+    reply = '[{"id": 1, "instruction": "Search A", "depends_on": []}, {"id": 2, "instruction": "Search B", "depends_on": []}]'
+    assert [step["instruction"] for step in pipe.validate_plan(pipe.parse_response(reply))] == ["Search A", "Search B"]
+
+
+def test_validate_plan_rejects_empty_plan(pipe):
+    with pytest.raises(ValueError):
+        pipe.validate_plan(pipe.parse_response('{"id": 1, "instruction": "Search A"}'))
+
+
+####################
+# build_plan_graph
+####################
+def test_build_plan_graph_renumbers_steps_and_maps_dependencies(pipe):
+    plan = {"plan": [
+        {"id": 10, "instruction": "Query documents", "depends_on": []},
+        {"id": 20, "instruction": "Search A", "depends_on": [10]},
+        {"id": 30, "instruction": "Search B", "depends_on": ["10"]},
+        {"id": 40, "instruction": "Summarize", "depends_on": [20, 30]},
+    ]}
+    assert pipe.build_plan_graph(plan) == [
+        {"id": 1, "instruction": "Query documents", "depends_on": []},
+        {"id": 2, "instruction": "Search A", "depends_on": [1]},
+        {"id": 3, "instruction": "Search B", "depends_on": [1]},
+        {"id": 4, "instruction": "Summarize", "depends_on": [2, 3]},
+    ]
+
+
+def test_build_plan_graph_string_steps_depend_on_the_step_before(pipe):
+    assert pipe.build_plan_graph({"plan": ["Search A", "Summarize"]}) == [
+        {"id": 1, "instruction": "Search A", "depends_on": []},
+        {"id": 2, "instruction": "Summarize", "depends_on": [1]},
+    ]
+
+
+def test_build_plan_graph_single_string_plan(pipe):
+    assert pipe.build_plan_graph({"plan": "Search A"}) == [{"id": 1, "instruction": "Search A", "depends_on": []}]
+
+
+def test_build_plan_graph_drops_forward_self_and_unknown_dependencies(pipe):
+    plan = {"plan": [
+        {"id": 1, "instruction": "Search A", "depends_on": [2]},
+        {"id": 2, "instruction": "Search B", "depends_on": [2, 99]},
+        {"id": 3, "instruction": "Summarize", "depends_on": 1},
+    ]}
+    assert pipe.build_plan_graph(plan) == [
+        {"id": 1, "instruction": "Search A", "depends_on": []},
+        {"id": 2, "instruction": "Search B", "depends_on": []},
+        {"id": 3, "instruction": "Summarize", "depends_on": [1]},
+    ]
+
+
+def test_build_plan_graph_drops_empty_steps_and_dependencies_on_them(pipe):
+    plan = {"plan": [
+        {"id": 1, "instruction": "Search A", "depends_on": []},
+        {"id": 2, "instruction": "  ", "depends_on": []},
+        {"id": 3, "instruction": "Summarize", "depends_on": [1, 2]},
+    ]}
+    assert pipe.build_plan_graph(plan) == [
+        {"id": 1, "instruction": "Search A", "depends_on": []},
+        {"id": 3, "instruction": "Summarize", "depends_on": [1]},
+    ]
+
+
+@pytest.mark.parametrize("plan_dict", [{}, {"plan": None}, {"plan": {"id": 1}}, {"plan": []}])
+def test_build_plan_graph_without_steps(pipe, plan_dict):
+    assert pipe.build_plan_graph(plan_dict) == []
@@ -0,0 +1,173 @@
+import asyncio
+
+from granite_autogen_rag import LANE_FINAL_ANSWER, LANE_PLAN_STEPS, LANE_UTILITY, LLMScheduler
+
+
+async def settle():
+    # Let every ready task run until it blocks again
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_waiters_are_admitted_by_lane_then_arrival():
+    async def run():
+        scheduler = LLMScheduler(1)
+        admitted = []
+
+        async def call(name, lane):
+            async with scheduler.slot(lane):
+                admitted.append(name)
+                await asyncio.sleep(0)
+
+        async with scheduler.slot(LANE_PLAN_STEPS):
+            tasks = [asyncio.ensure_future(call(name, lane)) for name, lane in [
+                ("step 1", LANE_PLAN_STEPS), ("final 1", LANE_FINAL_ANSWER), ("step 2", LANE_PLAN_STEPS),
+                ("utility", LANE_UTILITY), ("final 2", LANE_FINAL_ANSWER),
+            ]]
+            await settle()
+            assert admitted == []
+            assert scheduler.stats()["lanes"]["plan_steps"]["waiting"] == 2
+        await asyncio.gather(*tasks)
+        return scheduler, admitted
+
+    scheduler, admitted = asyncio.run(run())
+    assert admitted == ["utility", "final 1", "final 2", "step 1", "step 2"]
+    assert scheduler.active == 0
+
+
+def test_limit_caps_concurrent_calls():
+    async def run():
+        scheduler = LLMScheduler(2)
+        running = 0
+        peak = 0
+
+        async def call():
+            nonlocal running, peak
+            async with scheduler.slot(LANE_PLAN_STEPS):
+                running += 1
+                peak = max(peak, running)
+                await asyncio.sleep(0.01)
+                running -= 1
+
+        await asyncio.gather(*[call() for _ in range(6)])
+        return scheduler, peak
+
+    scheduler, peak = asyncio.run(run())
+    assert peak == 2
+    assert scheduler.active == 0
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    async def run():
+        scheduler = LLMScheduler(1)
+
+        async def wait_for_slot():
+            async with scheduler.slot(LANE_PLAN_STEPS):
+                pass
+
+        async with scheduler.slot(LANE_PLAN_STEPS):
+            waiter = asyncio.ensure_future(wait_for_slot())
+            await settle()
+            waiter.cancel()
+            await asyncio.gather(waiter, return_exceptions=True)
+            assert scheduler.waiting == []
+        assert scheduler.active == 0
+        # The slot is free again for the next call
+        await asyncio.wait_for(wait_for_slot(), timeout=1)
+        return scheduler
+
+    assert asyncio.run(run()).active == 0
+
+
+def test_waiter_cancelled_after_being_admitted_returns_its_slot():
+    async def run():
+        scheduler = LLMScheduler(1)
+
+        async def wait_for_slot():
+            async with scheduler.slot(LANE_PLAN_STEPS):
+                pass
+
+        holder = scheduler.slot(LANE_PLAN_STEPS)
+        await holder.__aenter__()
+        waiter = asyncio.ensure_future(wait_for_slot())
+        await settle()
+        # The slot is handed to the waiter, which is cancelled before it gets to run
+        await holder.__aexit__(None, None, None)
+        assert scheduler.active == 1
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        return scheduler
+
+    scheduler = asyncio.run(run())
+    assert scheduler.active == 0
+    assert scheduler.waiting == []
+
+
+def test_identical_calls_in_flight_are_coalesced():
+    async def run():
+        scheduler = LLMScheduler(4)
+        calls = 0
+        release = asyncio.Event()
+
+        async def call():
+            nonlocal calls
+            calls += 1
+            await release.wait()
+            return {"content": "answer"}
+
+        tasks = [asyncio.ensure_future(scheduler.run(LANE_PLAN_STEPS, call, "key")) for _ in range(3)]
+        await settle()
+        release.set()
+        results = await asyncio.gather(*tasks)
+        return scheduler, calls, results
+
+    scheduler, calls, results = asyncio.run(run())
+    assert calls == 1
+    assert [coalesced for _, coalesced in results] == [False, True, True]
+    assert all(result == {"content": "answer"} for result, _ in results)
+    assert scheduler.coalesced == 2
+    assert scheduler.in_flight == {}
+
+
+def test_coalesced_call_survives_cancellation_of_the_first_caller():
+    async def run():
+        scheduler = LLMScheduler(4)
+        release = asyncio.Event()
+
+        async def call():
+            await release.wait()
+            return "answer"
+
+        first = asyncio.ensure_future(scheduler.run(LANE_PLAN_STEPS, call, "key"))
+        await settle()
+        second = asyncio.ensure_future(scheduler.run(LANE_PLAN_STEPS, call, "key"))
+        await settle()
+        first.cancel()
+        await asyncio.gather(first, return_exceptions=True)
+        release.set()
+        return scheduler, first, await second
+
+    scheduler, first, second = asyncio.run(run())
+    assert first.cancelled()
+    assert second == ("answer", True)
+    assert scheduler.active == 0
+    assert scheduler.in_flight == {}
+
+
+def test_calls_without_a_key_are_not_coalesced():
+    async def run():
+        scheduler = LLMScheduler(0)
+        calls = 0
+
+        async def call():
+            nonlocal calls
+            calls += 1
+            await asyncio.sleep(0)
+            return "answer"
+
+        results = await asyncio.gather(*[scheduler.run(LANE_PLAN_STEPS, call) for _ in range(3)])
+        return calls, results
+
+    calls, results = asyncio.run(run())
+    assert calls == 3
+    assert not any(coalesced for _, coalesced in results)
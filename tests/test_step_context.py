@@ -0,0 +1,62 @@
+import asyncio
+
+from granite_autogen_rag import StepContext, count_tokens
+
+
+async def verbose_summarize(summary, output, max_tokens):
+    # A model that ignores the length it was asked for
+    return f"{summary} {output}".strip()
+
+
+def test_context_under_budget_is_kept_verbatim():
+    async def run():
+        context = StepContext(1000, verbose_summarize)
+        await context.add("Kubernetes 1.30 was released.")
+        await context.add("Ray 2.9 was released.")
+        return context
+
+    context = asyncio.run(run())
+    assert context.summary == ""
+    assert context.render() == "Kubernetes 1.30 was released.\n\nRay 2.9 was released."
+
+
+def test_context_stays_within_budget():
+    async def run():
+        context = StepContext(50, verbose_summarize)
+        for index in range(20):
+            await context.add(f"Finding {index}: " + "the team uses Kubernetes and Ray for distributed training. " * 3)
+        return context
+
+    context = asyncio.run(run())
+    assert count_tokens(context.summary) <= context.summary_budget
+    assert count_tokens(context.render()) <= 50 + count_tokens("Summary of earlier findings: ")
+
+
+def test_single_output_over_budget_is_summarized():
+    async def run():
+        context = StepContext(50, verbose_summarize)
+        await context.add("word " * 500)
+        return context
+
+    context = asyncio.run(run())
+    assert context.outputs == []
+    assert count_tokens(context.summary) <= context.summary_budget
+    assert context.uncompressed_tokens >= 500 // 4
+
+
+def test_summarizer_is_asked_for_the_summary_budget():
+    requested = []
+
+    async def summarize(summary, output, max_tokens):
+        requested.append(max_tokens)
+        return "short"
+
+    async def run():
+        context = StepContext(40, summarize)
+        await context.add("a " * 60)
+        await context.add("b " * 60)
+        return context
+
+    context = asyncio.run(run())
+    assert requested and all(max_tokens == 20 for max_tokens in requested)
+    assert context.summary == "short"